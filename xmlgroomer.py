@@ -12,12 +12,26 @@ import re
 import traceback
 import string
 import argparse
+import os
+import glob
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import StringIO
+import functools
+import collections
+import json
+import hashlib
+import shutil
+import tempfile
+import codecs
+import mmap
+import threading
 
 
 groomers = []
 validators = []
 char_stream_groomers = []
-output = ''
 
 
 def register_groom(fn):
@@ -33,13 +47,538 @@ def register_validator(fn):
 
 
 def register_char_stream_groom(fn):
-    global groomers
+    global char_stream_groomers
     char_stream_groomers.append(fn)
     return fn
 
 
+class Finding(object):
+    """One line of a groomer report."""
+
+    def __init__(self, severity, message, groomer=None):
+        self.severity = severity
+        self.message = message
+        self.groomer = groomer
+
+    def render(self, dry_run=False):
+        severity = self.severity
+        if dry_run and severity == 'correction':
+            severity = 'suggested correction'
+        return '%s: %s\n' % (severity, self.message)
+
+
+class Report(object):
+    """Findings collected while grooming one article.
+
+    The runner sets `groomer`, so each finding records who emitted it, and
+    lists groomers that raised in `failed` and those that did not apply in
+    `skipped`.  `changes` counts the corrections.  `touched` lists the
+    elements groomers changed; `untracked` is set once the tree may have
+    changed elsewhere too (see tracks_changes).
+    """
+
+    def __init__(self):
+        self.findings = []
+        self.groomer = None
+        self.failed = []
+        self.skipped = []
+        self.changes = 0
+        self.touched = []
+        self.untracked = False
+
+    def add(self, severity, message):
+        self.findings.append(Finding(severity, message, self.groomer))
+        if severity == 'correction':
+            self.changes += 1
+
+    def touch(self, *nodes):
+        self.touched.extend(nodes)
+
+    def correction(self, message, *nodes):
+        self.add('correction', message)
+        self.touch(*nodes)
+
+    def warning(self, message):
+        self.add('warning', message)
+
+    def error(self, message):
+        self.add('error', message)
+
+    def merge(self, other):
+        """Add the findings, failures and touched elements of other."""
+        self.findings.extend(other.findings)
+        self.failed.extend(other.failed)
+        self.changes += other.changes
+        self.touched.extend(other.touched)
+        self.untracked = self.untracked or other.untracked
+
+    def render(self, dry_run=False):
+        """Format the findings, then in a dry run the groomers skipped."""
+        output = ''.join(finding.render(dry_run) for finding in self.findings)
+        if dry_run and self.skipped:
+            output += 'skipped, not for this journal or article type: %s\n' % ', '.join(self.skipped)
+        return output
+
+
+_local = threading.local()
+
+
+class XPathRegistry(object):
+    """Compiled XPath expressions shared by all groomers.
+
+    Call as xpath(node, path).  Each path is compiled the first time it is
+    used and reused from then on.  Queries from the root of the document
+    run_groomers is working on are answered from its QueryCache when they
+    can be.  counts records how many times each path has been evaluated and
+    hits how many times it was answered from a QueryCache instead, since the
+    last reset.  Read-only checks may evaluate paths from several threads
+    at once (see run_checks), so the counters are updated under lock.
+    """
+
+    def __init__(self):
+        self.compiled = {}
+        self.counts = collections.Counter()
+        self.hits = collections.Counter()
+        self.lock = threading.Lock()
+
+    def compile(self, path):
+        compiled = self.compiled.get(path)
+        if compiled is None:
+            compiled = self.compiled[path] = etree.XPath(path)
+        return compiled
+
+    def __call__(self, node, path):
+        queries = getattr(_local, 'queries', None)
+        if queries is not None and queries.root is node:
+            return queries.get(self, path)
+        with self.lock:
+            self.counts[path] += 1
+        return self.compile(path)(node)
+
+xpath = XPathRegistry()
+
+
+class QueryCache(object):
+    """XPath results from the root of one document, remembered while valid.
+
+    A result is reused until report gets a correction, or until clear() is
+    called; run_groomers clears the cache whenever a groomer may have
+    changed the tree (see may_have_changed).  Callers get their own copy of
+    node lists.
+    """
+
+    def __init__(self, root, report):
+        self.root = root
+        self.report = report
+        self.results = {}
+
+    def get(self, registry, path):
+        entry = self.results.get(path)
+        if entry is not None and entry[0] == self.report.changes:
+            with registry.lock:
+                registry.hits[path] += 1
+            result = entry[1]
+        else:
+            with registry.lock:
+                registry.counts[path] += 1
+            result = registry.compile(path)(self.root)
+            self.results[path] = (self.report.changes, result)
+        return list(result) if isinstance(result, list) else result
+
+    def clear(self):
+        self.results.clear()
+
+
+def has_parents(node, path, attrib=None):
+    """True if node's ancestors end in path, e.g. 'article/body/sec' for a
+    node whose parent is a sec in a body in an article.  attrib, if given,
+    must match the attributes of the immediate parent.
+    """
+    parent = node.getparent()
+    if attrib and (parent is None or any(parent.get(k) != v for k, v in attrib.items())):
+        return False
+    for tag in reversed(path.split('/')):
+        if parent is None or parent.tag != tag:
+            return False
+        parent = parent.getparent()
+    return True
+
+
+def has_ancestor(node, tag):
+    return next(node.iterancestors(tag), None) is not None
+
+
+def last_text(element):
+    """Return (node, attribute) for the text that ends element's mixed
+    content: element.text if it has no children, else the last child's tail.
+    """
+    if len(element):
+        return element[-1], 'tail'
+    return element, 'text'
+
+
+def rewrite_text(node, attribute, pattern, replacement):
+    """Apply re.sub(pattern, replacement) to node.text or node.tail in place.
+    Returns the old text if it changed, else None.
+    """
+    old = getattr(node, attribute)
+    if old is None:
+        return None
+    new = re.sub(pattern, replacement, old)
+    if new == old:
+        return None
+    setattr(node, attribute, new)
+    return old
+
+
+_whitespace = re.compile(r'[ \t\n\r\f\v]')
+_ascii_lower = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_unicode_ascii_lower = dict((ord(upper), ord(lower)) for upper, lower
+                            in zip(string.ascii_uppercase, string.ascii_lowercase))
+
+
+def ascii_lower(text):
+    """Lowercase the ASCII letters of text and no others, as re.IGNORECASE
+    does without re.UNICODE.
+    """
+    if isinstance(text, unicode):
+        return text.translate(_unicode_ascii_lower)
+    if isinstance(text, str):
+        return text.translate(_ascii_lower)
+    # as re.search did
+    raise TypeError('expected string or buffer')
+
+
+def words(text):
+    """Split ascii_lower(text) at every character re's \\s matches without
+    re.UNICODE.  Runs of whitespace give empty words, so words(text)[1:]
+    are the words that follow a whitespace character.
+    """
+    return _whitespace.split(ascii_lower(text))
+
+
+# words that make an author name look like a collaboration, on their own or
+# at the start of a word
+COLLAB_WORDS = frozenset(['the', 'for', 'of', 'on', 'in', 'with', 'group', 'collaborative', 'society'])
+COLLAB_PREFIXES = ('center', 'organization', 'organizing', 'collaboration', 'committee', 'council',
+                   'consortium', 'association', 'partnership', 'project', 'team')
+# how a collab that should be an on-behalf-of starts
+ON_BEHALF_OF_PREFIXES = ('for', 'on behalf of')
+
+
+def looks_like_collab(name):
+    """True if name has three or more whitespace characters, one of
+    COLLAB_WORDS between two of them, or a word starting with one of
+    COLLAB_PREFIXES after one.
+    """
+    name_words = words(name)
+    return (len(name_words) > 3
+            or any(word in COLLAB_WORDS for word in name_words[1:-1])
+            or any(word.startswith(COLLAB_PREFIXES) for word in name_words[1:]))
+
+
+def contains_beta(text):
+    if not isinstance(text, basestring):
+        # as re.search did
+        raise TypeError('expected string or buffer')
+    return u'\u03B2' in text
+
+
+memoized = []
+
+
+class LRUCache(object):
+    """A pure function that remembers its results for the arguments it was
+    called with most recently, at most maxsize of them.
+
+    Made with @memoize.  Results are kept in two generations of plain
+    dicts: new results go in the current one, and a result found in the
+    previous one moves to the current one.  Once the current generation
+    holds maxsize / 2 results it becomes the previous one, and the results
+    not used since are dropped.  Results are kept for the life of the
+    process, so they are shared by every article it grooms.  hits and
+    misses count the calls answered from and added to the cache, and show
+    up in profiles.
+    """
+
+    def __init__(self, fn, maxsize):
+        self.fn = fn
+        self.generation_size = max(maxsize // 2, 1)
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            result = self.current.get(args, _missing)
+            if result is _missing:
+                result = self.previous.get(args, _missing)
+                if result is not _missing:
+                    self.store(args, result)
+            if result is not _missing:
+                self.hits += 1
+                return result
+        result = self.fn(*args)
+        with self.lock:
+            self.misses += 1
+            self.store(args, result)
+        return result
+
+    def store(self, args, result):
+        self.current[args] = result
+        if len(self.current) >= self.generation_size:
+            self.previous = self.current
+            self.current = {}
+
+    def clear(self):
+        with self.lock:
+            self.current = {}
+            self.previous = {}
+
+_missing = object()
+
+
+def memoize(maxsize):
+    """Decorate a pure function to remember its last maxsize results."""
+    def decorator(fn):
+        cache = functools.wraps(fn)(LRUCache(fn, maxsize))
+        memoized.append(cache)
+        return cache
+    return decorator
+
+
+def dispatch_on(*tags, **kwargs):
+    """Declare the elements a groomer works on instead of searching for them.
+
+    The groomer is called as groomer(root, report, nodes), nodes being the
+    elements with one of tags (that also pass the optional match predicate)
+    in document order.  run_groomers collects the nodes of consecutive
+    dispatched groomers in one walk of the tree, before any of them runs, so
+    a dispatched groomer must not add, remove or replace nodes that a later
+    one in the same run dispatches on.  Called directly, a dispatched
+    groomer collects its own nodes.
+    """
+    match = kwargs.pop('match', None)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def groomer(root, report, nodes=None):
+            if nodes is None:
+                nodes = collect_nodes(root, [groomer])[0]
+            return fn(root, report, nodes)
+        groomer.tags = tags
+        groomer.match = match
+        return groomer
+    return decorator
+
+
+def collect_nodes(root, dispatched):
+    """Walk root once and sort its elements into one node list per groomer."""
+    nodes = [[] for groomer in dispatched]
+    handlers = {}
+    for i, groomer in enumerate(dispatched):
+        for tag in groomer.tags:
+            handlers.setdefault(tag, []).append(i)
+    for node in root.iter(*handlers):
+        for i in handlers[node.tag]:
+            match = dispatched[i].match
+            if match is None or match(node):
+                nodes[i].append(node)
+    return nodes
+
+
+# the parts of an article groomers declare they read, as XPaths from the root
+REGIONS = {
+    'article-type': "@article-type",
+    'front': "front",
+    'journal-meta': "front/journal-meta",
+    'article-meta': "front/article-meta",
+    'contribs': "//contrib[not(ancestor::contrib)]",
+    'ref-list': "back/ref-list",
+    'comments': "//comment/..",
+    'supplementary-material': "//supplementary-material",
+    'body-titles': "//sec/title | //sec/@sec-type",
+}
+
+
+def reads(*regions):
+    """Declare everything a groomer reads, as names of REGIONS.
+
+    Incremental runs (see ArticleHistory) skip a groomer whose regions are
+    unchanged since its last run, so the declaration must be complete.
+    Groomers that read outside these regions, or change the tree without
+    reporting a correction, declare nothing and always run.
+    """
+    def decorator(fn):
+        fn.regions = regions
+        return fn
+    return decorator
+
+
+def read_only(fn):
+    """Mark a groomer that only reports and never changes the tree."""
+    fn.read_only = True
+    return fn
+
+
+def tracks_changes(fn):
+    """Mark a fixer that passes every element it changes to report.touch or
+    report.correction: the element itself for changes to its attributes or
+    content, its parent for removals, insertions, renames and changes to its
+    tail.
+    Articles changed only by such fixers can be spliced (see splice_article).
+    """
+    fn.tracks_changes = True
+    return fn
+
+
+def front_matter(fn):
+    """Mark a validator that reads nothing after the article's front.
+
+    When every validator is marked, error checks parse articles only as far
+    as </front> (see parse_front).
+    """
+    fn.front_matter = True
+    return fn
+
+
+def applies_to(journals=None, subjects=None):
+    """Declare that a groomer does nothing unless the article's pmc
+    journal-id is one of journals and its heading subject one of subjects.
+    Either may be a function of the vocabulary.  Articles whose journal or
+    subject is missing or ambiguous always get the groomer; other articles
+    leave it out of their pipeline, so earlier fixers must not change either.
+    """
+    def decorator(fn):
+        fn.journals = journals
+        fn.subjects = subjects
+        return fn
+    return decorator
+
+
+def applicable(groomer, attribute):
+    """The journals or subjects groomer applies_to, or None for all."""
+    values = getattr(groomer, attribute, None)
+    if callable(values):
+        return values(vocabulary)
+    return values
+
+
+def applies(groomer, journal, subject):
+    """Tell whether groomer may do anything for an article of journal and
+    subject, None standing for unknown (see applies_to).
+    """
+    journals = applicable(groomer, 'journals')
+    subjects = applicable(groomer, 'subjects')
+    return ((journals is None or journal is None or journal in journals)
+            and (subjects is None or subject is None or subject in subjects))
+
+
+_pipelines = {}
+
+
+def pipeline(groomer_list, journal, subject):
+    """Return (pipeline, skipped): groomer_list without the groomers that do
+    not apply to articles of journal and subject, and the names of those.
+
+    Pipelines are made once per groomer list, vocabulary and (journal,
+    subject) and reused.  Journals and subjects no groomer in the list
+    applies_to share one pipeline.
+    """
+    list_key = (tuple(groomer_list), vocabulary.digest)
+    compiled = _pipelines.get(list_key)
+    if compiled is None:
+        journals, subjects = set(), set()
+        for groomer in groomer_list:
+            journals.update(applicable(groomer, 'journals') or [])
+            subjects.update(applicable(groomer, 'subjects') or [])
+        compiled = _pipelines[list_key] = (journals, subjects, {})
+    journals, subjects, pipelines = compiled
+    if journal is not None and journal not in journals:
+        journal = ''
+    if subject is not None and subject not in subjects:
+        subject = ''
+    result = pipelines.get((journal, subject))
+    if result is None:
+        result = pipelines[journal, subject] = (
+            [groomer for groomer in groomer_list if applies(groomer, journal, subject)],
+            [groomer.__name__ for groomer in groomer_list if not applies(groomer, journal, subject)])
+    return result
+
+
+class ArticleIndex(object):
+    """Facts many groomers need, gathered in one walk of an article.
+
+    Get it with article_index(root).  tags lists the indexed elements by
+    tag; journal is the article's Journal, found by its pmc journal-id or
+    else its journal title, or None.  The index holds elements, not their
+    text, so it stays correct while groomers edit text and attributes.
+    run_groomers drops it whenever a groomer may have changed the tree.
+    """
+
+    indexed_tags = ['article-id', 'journal-id', 'journal-title', 'pub-date', 'subject', 'aff']
+
+    def __init__(self, root):
+        self.root = root
+        self.tags = dict((tag, []) for tag in self.indexed_tags)
+        for node in root.iter(*self.indexed_tags):
+            self.tags[node.tag].append(node)
+        self.article_dois = [node for node in self.tags['article-id'] if node.get('pub-id-type') == 'doi']
+        self.journal_ids = {}
+        for node in self.tags['journal-id']:
+            self.journal_ids.setdefault(node.get('journal-id-type'), []).append(node)
+        self.epub_dates = [node for node in self.tags['pub-date'] if node.get('pub-type') == 'epub']
+        pmc = self.journal_ids.get('pmc')
+        titles = [node for node in self.tags['journal-title'] if has_parents(node, 'journal-title-group')]
+        self.journal = ((pmc and vocabulary.journals_by_pmc.get(pmc[0].text))
+                        or (titles and vocabulary.journals_by_title.get(titles[0].text)) or None)
+        self.heading_subjects = [node for node in self.tags['subject']
+                                 if has_parents(node, 'subj-group', {'subj-group-type': 'heading'})
+                                 and has_ancestor(node, 'article-categories')]
+
+    @property
+    def doi(self):
+        return self.article_dois[0].text
+
+    @property
+    def doi_suffix(self):
+        """The DOI without "10.1371/journal.", e.g. pone.0012345."""
+        return self.doi.split('10.1371/journal.')[1]
+
+    def kind(self):
+        """The (journal, subject) of the article for applies_to: the pmc
+        journal-id of its journal and its heading subject, None where there
+        is none, or more than one subject.
+        """
+        journals = self.journal_ids.get('pmc')
+        if self.journal is not None:
+            journal = self.journal.pmc
+        else:
+            journal = journals[0].text if journals else None
+        subject = self.heading_subjects[0].text if len(self.heading_subjects) == 1 else None
+        return journal, subject
+
+    def epub(self, field):
+        """The field (year, month or day) elements of the epub pub-dates."""
+        return [node for date in self.epub_dates for node in date if node.tag == field]
+
+
+def article_index(root):
+    """Return the ArticleIndex of root, building it if there is none."""
+    index = getattr(_local, 'index', None)
+    if index is None or index.root is not root:
+        index = _local.index = ArticleIndex(root)
+    return index
+
+
+def invalidate_index():
+    _local.index = None
+
+
 def get_doi(root):
-    return root.xpath("//article-id[@pub-id-type='doi']")[0].text
+    return article_index(root).doi
 
 
 def get_singular_node(elmnt, path):
@@ -50,154 +589,266 @@ def get_singular_node(elmnt, path):
         Returns single node specified in path or raises and error
         if node doesn't exist or too many exist.
     """
-    matches = elmnt.xpath(path)
+    return singular(xpath(elmnt, path), path)
+
+
+def singular(matches, path):
+    """Return the only node in matches, found with path, or raise ValueError."""
     if len(matches) > 1:
         raise ValueError("Found %s %s(s) when only looking for 1" %
-                         (len(elmnt.xpath(path)), path))
+                         (len(matches), path))
     elif len(matches) == 0:
         raise ValueError("%s doesn't exist!" % (path))
     else:
         return matches[0]
 
 
-def fix_article_type(root):
-    global output
-    atitle = get_singular_node(root, "//article-categories//subj-group[@subj-group-type='heading']/subject")
-    bad = ['Clinical Trial', 'Research article', 'Research Articles']
-    if atitle.text in bad:
+VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vocabulary.json')
+
+
+class Journal(object):
+    """One journal of the vocabulary, made from its entry in the file.
+
+    pmc is its pmc journal-id, if it has one; title and nlm_tas are the
+    journal-meta values valid for it; founded is the year of its first
+    volume; article_types are the article types valid only in it.  blurb
+    is set if its articles need a toc abstract, and collection_month is
+    cleared if its collection pub-dates have no month.
+    """
+
+    def __init__(self, entry):
+        self.pmc = entry.get('pmc')
+        self.title = entry['title']
+        self.nlm_tas = frozenset(entry.get('nlm_tas', []))
+        self.founded = entry.get('founded')
+        self.article_types = frozenset(entry.get('article_types', []))
+        self.blurb = entry.get('blurb', False)
+        self.collection_month = entry.get('collection_month', True)
+
+
+class Vocabulary(object):
+    """The controlled vocabularies groomers check articles against.
+
+    Loaded from a JSON file (see vocabulary.json) with these keys:
+    article_types, the valid heading subjects; article_type_fixes, a map of
+    misspelt heading subjects to the right ones; and journals, a list with
+    one entry per journal (see Journal).  The valid nlm_tas and
+    journal_titles are those of all the journals.  Groomers read the
+    module's `vocabulary`; reload_vocabulary replaces it while a process
+    runs.  digest identifies the file's contents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.mtime = os.path.getmtime(path)
+        self.digest = hashlib.sha1(content).hexdigest()
+        data = json.loads(content)
+        self.article_types = frozenset(data['article_types'])
+        self.article_type_fixes = dict(data['article_type_fixes'])
+        self.journals = [Journal(entry) for entry in data['journals']]
+        self.journals_by_pmc = dict((journal.pmc, journal) for journal in self.journals if journal.pmc)
+        self.journals_by_title = dict((journal.title, journal) for journal in self.journals)
+        self.nlm_tas = frozenset(nlm_ta for journal in self.journals for nlm_ta in journal.nlm_tas)
+        self.journal_titles = frozenset(self.journals_by_title)
+        self.blurb_journals = frozenset(journal.pmc for journal in self.journals if journal.blurb)
+        self.journal_article_types = dict((journal, self.article_types | journal.article_types)
+                                          for journal in self.journals)
+
+    def article_types_for(self, journal):
+        """The valid article types of journal, a Journal or None."""
+        return self.journal_article_types.get(journal, self.article_types)
+
+    def changed(self):
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return False
+
+vocabulary = Vocabulary(VOCABULARY_PATH)
+
+
+def reload_vocabulary(path=None):
+    """Load the vocabulary from path, by default the file it was last loaded
+    from, and use it for every article groomed from now on.
+    """
+    global vocabulary
+    vocabulary = Vocabulary(path or vocabulary.path)
+    return vocabulary
+
+
+def refresh_vocabulary():
+    """Reload the vocabulary if its file changed since it was loaded.  A file
+    that cannot be loaded is reported and the vocabulary in use kept.
+    """
+    if vocabulary.changed():
+        try:
+            reload_vocabulary()
+        except (IOError, OSError, ValueError, KeyError) as ee:
+            print >>sys.stderr, '** error reloading vocabulary: '+str(ee)
+
+
+# heading subjects of notices about another article
+CORRECTION_SUBJECTS = ['Correction', 'Retraction', 'Expression of Concern']
+
+
+@reads('article-meta')
+@tracks_changes
+def fix_article_type(root, report):
+    atitle = singular(article_index(root).heading_subjects,
+                      "//article-categories//subj-group[@subj-group-type='heading']/subject")
+    fixed = vocabulary.article_type_fixes.get(atitle.text)
+    if fixed is not None:
         old = atitle.text
-        atitle.text = 'Research Article'
-        output += 'correction: changed article type from "%s" to "Research Article"\n' % old
+        atitle.text = fixed
+        report.correction('changed article type from "%s" to "%s"' % (old, fixed), atitle)
     return root
 groomers.append(fix_article_type)
 
 
-def check_correction_article(root):
-    global output
-    cxns = ['Correction', 'Retraction', 'Expression of Concern']
-    if get_singular_node(root, "//article-categories//subj-group[@subj-group-type='heading']/subject").text in cxns:
+@reads('article-meta', 'article-type')
+@applies_to(subjects=CORRECTION_SUBJECTS)
+@tracks_changes
+def check_correction_article(root, report):
+    cxns = CORRECTION_SUBJECTS
+    subj = singular(article_index(root).heading_subjects,
+                    "//article-categories//subj-group[@subj-group-type='heading']/subject").text
+    if subj in cxns:
         try:
-            subj = get_singular_node(root, "//article-categories//subj-group[@subj-group-type='heading']/subject").text
             ra = get_singular_node(root,'//article-meta/related-article')
             article = get_singular_node(root, '//article')
             if subj == 'Correction' and ra.attrib['related-article-type'] != 'corrected-article':
-                output += "error: related-article-type is not 'corrected-article'\n"
+                report.error("related-article-type is not 'corrected-article'")
             elif ra.attrib['related-article-type'] == 'corrected-article' and article.attrib['article-type'] != 'correction':
-                output += "error: article element article-type attribute not 'correction'\n"
+                report.error("article element article-type attribute not 'correction'")
             elif subj == 'Retraction':
                 if ra.attrib['related-article-type'] != 'retracted-article':
                     oldratype = ra.attrib['related-article-type']
                     ra.attrib['related-article-type'] = 'retracted-article'
-                    output += "correction: related-article-type changed from "+oldratype+" to 'retracted-article'\n"
+                    report.correction("related-article-type changed from "+oldratype+" to 'retracted-article'", ra)
                 if article.attrib['article-type'] != 'retraction':
                     oldaatype = article.attrib['article-type']
                     article.attrib['article-type'] = 'retraction'
-                    output += "correction: article element article-type attribute changed from "+oldaatype+" to 'retraction'\n"
+                    report.correction("article element article-type attribute changed from "+oldaatype+" to 'retraction'",
+                                      article)
             elif subj == 'Expression of Concern' and ra.attrib['related-article-type'] != 'object-of-concern':
-                output += "error: related-article-type is not 'object-of-concern'\n"
+                report.error("related-article-type is not 'object-of-concern'")
             elif ra.attrib['related-article-type'] == 'object-of-concern' and article.attrib['article-type'] != 'expression-of-concern':
-                output += "error: article element article-type attribute not 'expression-of-concern'\n"
+                report.error("article element article-type attribute not 'expression-of-concern'")
         except ValueError:
-            output += 'error: no related article element\n'
+            report.error('no related article element')
     return root
 groomers.append(check_correction_article)
 
 
-def fix_subject_category(root):
-    global output
-    discipline_v2 = (root.xpath("//subj-group"
+def fix_subject_category(root, report):
+    discipline_v2 = (xpath(root, "//subj-group"
                                 "[@subj-group-type='Discipline-v2']"))
     if discipline_v2:
         for subj in discipline_v2:
             subj.getparent().remove(subj)
-        output += 'correction: removed Discipline-v2 categories\n'
+        report.correction('removed Discipline-v2 categories')
     return root
 #groomers.append(fix_subject_category)
 
 
-def fix_article_title(root):
-    global output
-    for title in root.xpath("//title-group/article-title"):
-        if re.search(r'[\t\n\r]| {2,}', unicode(title.text)):
-            old_title = title.text
-            title.text = re.sub(r'[\t\n\r ]+', r' ', unicode(title.text))
-            output += 'correction: changed article title from '\
-                      + old_title + ' to ' + title.text + '\n'
+@reads('article-meta')
+@tracks_changes
+@dispatch_on('article-title', match=lambda node: has_parents(node, 'title-group'))
+def fix_article_title(root, report, titles):
+    for title in titles:
+        old_title = rewrite_text(title, 'text', r'[\t\n\r ]+', u' ')
+        if old_title is not None:
+            report.correction('changed article title from '
+                              + old_title + ' to ' + title.text, title)
     return root
 groomers.append(fix_article_title)
 
 
-def fix_bad_italic_tags_running_title(root):
-    global output
+@reads('article-meta')
+@tracks_changes
+@dispatch_on('alt-title', match=lambda node: node.get('alt-title-type') == 'running-head'
+                                          and has_parents(node, 'title-group'))
+def fix_bad_italic_tags_running_title(root, report, alt_titles):
     changed = False
-    for typ in (root.xpath("//title-group/alt-title"
-                           "[@alt-title-type='running-head']")):
+    for typ in alt_titles:
         if not typ.text:
             continue
         atitle = html.fromstring(typ.text)
-        if atitle.xpath('//i'):
-            for i in atitle.xpath('//i'):
+        if xpath(atitle, '//i'):
+            for i in xpath(atitle, '//i'):
                 i.tag = 'italic'
             atitle.tag = 'alt-title'
             atitle.attrib['alt-title-type'] = 'running-head'
+            report.touch(typ.getparent())
             typ.getparent().replace(typ, atitle)
             changed = True
     if changed:
-        output += 'correction: fixed italic tags in running title\n'''
+        report.correction('fixed italic tags in running title')
     return root
 groomers.append(fix_bad_italic_tags_running_title)
 
-def check_au_names_for_beta(root):
-    global output
-    regex = u"\u03B2"  # "β"
+@reads('contribs')
+@read_only
+@dispatch_on('contrib', match=lambda node: node.get('contrib-type') == 'author')
+def check_au_names_for_beta(root, report, authors):
     german = u"\u00DF" # "ß"
-    for author in root.xpath("//contrib[@contrib-type='author']"):
-        if not author.xpath("collab"):
-            first = get_singular_node(author, "name/given-names").text
-            last = get_singular_node(author, "name/surname").text
-            if re.search(regex, first) or re.search(regex, last):
-                output += 'warning: "%s %s" contains a beta which might be incorrect. Consult manuscript to confirm whether beta was meant to be a German s-set character "%s"\n' % (first, last, german)
+    for author in authors:
+        collabs = [child for child in author if child.tag == 'collab']
+        if not collabs:
+            parts = [part for child in author if child.tag == 'name' for part in child]
+            first = singular([part for part in parts if part.tag == 'given-names'], 'name/given-names').text
+            last = singular([part for part in parts if part.tag == 'surname'], 'name/surname').text
+            if contains_beta(first) or contains_beta(last):
+                report.warning('"%s %s" contains a beta which might be incorrect. Consult manuscript to confirm whether beta was meant to be a German s-set character "%s"' % (first, last, german))
         else:
-            group = get_singular_node(author, 'collab').text
-            if re.search(regex, group):
-                output += 'warning: "%s" contains a beta which might be incorrect. Consult manuscript to confirm whether beta was meant to be a German s-set character "%s"\n' % (group, german)
+            group = singular(collabs, 'collab').text
+            if contains_beta(group):
+                report.warning('"%s" contains a beta which might be incorrect. Consult manuscript to confirm whether beta was meant to be a German s-set character "%s"' % (group, german))
     return root
 groomers.append(check_au_names_for_beta)
 
-def fix_affiliation(root):
-    global output
-    for author in root.xpath("//contrib[@contrib-type='author']"):
-        if not author.xpath("collab"):
-            aff = author.xpath("xref[@ref-type='aff']")
-            name = (author.xpath("name/surname")[0].text
-                    if author.xpath("name/surname")
-                    else author.xpath("collab")[0].text)
-            aff_count = len(root.xpath("//aff[starts-with(@id, 'aff')]"))
+@reads('article-meta')
+@tracks_changes
+@dispatch_on('contrib', match=lambda node: node.get('contrib-type') == 'author')
+def fix_affiliation(root, report, authors):
+    aff_count = len([aff for aff in article_index(root).tags['aff'] if aff.get('id', '').startswith('aff')])
+    for author in authors:
+        if not xpath(author, "collab"):
+            aff = xpath(author, "xref[@ref-type='aff']")
+            name = (xpath(author, "name/surname")[0].text
+                    if xpath(author, "name/surname")
+                    else xpath(author, "collab")[0].text)
             if not aff:
                 if aff_count == 1:
                     author.insert(1, etree.fromstring("""<xref ref-type='aff' rid='aff1'/>"""))
-                    output += 'correction: set rid=aff1 for '+name+'\n'
+                    report.correction('set rid=aff1 for '+name, author)
             elif aff[0].attrib['rid'] == 'aff':
                 aff[0].attrib['rid'] = 'aff1'
-                output += 'correction: set rid=aff1 for '+name+'\n'
+                report.correction('set rid=aff1 for '+name, aff[0])
     return root
 groomers.append(fix_affiliation)
 
 
-def fix_addrline(root):
-    global output
-    for addrline in root.xpath("//aff/addr-line"):
+@reads('article-meta')
+@tracks_changes
+@dispatch_on('addr-line', match=lambda node: has_parents(node, 'aff'))
+def fix_addrline(root, report, addrlines):
+    for addrline in addrlines:
         if addrline.tail in [',','.',':']:
             addrline.tail = ''
-            output += 'correction: removed punctuation after addr-line in '\
-                      + addrline.getparent().attrib['id'] + '\n'
+            report.correction('removed punctuation after addr-line in '
+                              + addrline.getparent().attrib['id'], addrline.getparent())
     return root
 groomers.append(fix_addrline)
 
 
-def fix_corresp_email(root):
-    global output
-    for corresp in root.xpath("//corresp"):
+@reads('article-meta')
+@tracks_changes
+@dispatch_on('corresp')
+def fix_corresp_email(root, report, corresps):
+    for corresp in corresps:
         if not corresp.getchildren():
             email = re.sub(r'(\S+@\S+)', r'<email xlink:type="simple">\1</email>', corresp.text)
             temp = etree.fromstring('<temp xmlns:xlink="http://www.w3.org/1999/xlink">'
@@ -205,48 +856,134 @@ def fix_corresp_email(root):
             corresp.text = ''
             corresp.append(temp)
             etree.strip_tags(corresp, 'temp')
-            output += 'correction: activated email in corresp '+corresp.attrib['id']+'\n'
+            report.correction('activated email in corresp '+corresp.attrib['id'], corresp)
     return root
 groomers.append(fix_corresp_email)
 
 
-def fix_pubdate(root):
-    global output
-    doi = get_doi(root)
-    proc = subprocess.Popen(['php', '/var/local/scripts/production/getPubdate.php', doi], shell=False, stdout=subprocess.PIPE)
-    pubdate = proc.communicate()[0]
+class PubdateProvider(object):
+    """Looks up EM pubdates ("YYYY-MM-DD", or '' if EM has none) by DOI.
+
+    Each DOI is resolved once per process and remembered in memo, so
+    fix_pubdate, check_pubdate and the ResultCache key share a single
+    lookup.  Subclasses implement fetch(dois), returning a dict of
+    pubdates, or of the exception a lookup failed with, which is then
+    raised for that DOI every time.
+    """
+
+    def __init__(self):
+        self.memo = {}
+
+    def lookup(self, doi):
+        return self.lookup_many([doi])[doi]
+
+    def lookup_many(self, dois):
+        # memo may be replaced by another thread meanwhile, but not changed
+        memo = self.memo
+        missing = set(doi for doi in dois if doi not in memo)
+        if missing:
+            memo.update(self.fetch(sorted(missing)))
+        for doi in dois:
+            if isinstance(memo[doi], Exception):
+                raise memo[doi]
+        return dict((doi, memo[doi]) for doi in dois)
+
+    def fetch(self, dois):
+        raise NotImplementedError
+
+
+class PhpPubdateProvider(PubdateProvider):
+    """Asks EM through getPubdate.php, running up to max_procs at a time.
+    A lookup still running after timeout seconds is killed, and fails.
+    """
+
+    script = '/var/local/scripts/production/getPubdate.php'
+    max_procs = 8
+    timeout = 30
+
+    def fetch(self, dois):
+        pubdates = {}
+        for i in range(0, len(dois), self.max_procs):
+            procs = [(doi, subprocess.Popen(['php', self.script, doi], shell=False, stdout=subprocess.PIPE))
+                     for doi in dois[i:i + self.max_procs]]
+            timers = [threading.Timer(self.timeout, kill_process, [proc]) for doi, proc in procs]
+            for timer in timers:
+                timer.start()
+            try:
+                for doi, proc in procs:
+                    pubdates[doi] = proc.communicate()[0]
+            finally:
+                for timer in timers:
+                    timer.cancel()
+            for doi, proc in procs:
+                if proc.returncode < 0:
+                    pubdates[doi] = RuntimeError('getPubdate.php gave no answer for %s in %g seconds'
+                                                 % (doi, self.timeout))
+        return pubdates
+
+
+def kill_process(proc):
+    try:
+        proc.kill()
+    except OSError:
+        pass    # it has exited already
+
+
+class FilePubdateProvider(PubdateProvider):
+    """Stand-in for EM reading tab-separated "doi YYYY-MM-DD" lines from a
+    file, for testing and benchmarking without PHP.  DOIs missing from the
+    file have no pubdate.
+    """
+
+    def __init__(self, path):
+        super(FilePubdateProvider, self).__init__()
+        self.pubdates = {}
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    self.pubdates[fields[0]] = fields[1]
+
+    def fetch(self, dois):
+        return dict((doi, self.pubdates.get(doi, '')) for doi in dois)
+
+pubdate_provider = PhpPubdateProvider()
+
+
+@tracks_changes
+def fix_pubdate(root, report):
+    pubdate = pubdate_provider.lookup(get_doi(root))
     if int(pubdate[:4]) > 2000:
         em = {'year':pubdate[:4], 'month':str(int(pubdate[5:7])), 'day':str(int(pubdate[8:]))}
-        for date in root.xpath("//pub-date[@pub-type='epub']"):
+        for date in article_index(root).epub_dates:
             for field in ['year','month','day']:
-                xml_val = date.xpath(field)[0].text
+                xml_val = xpath(date, field)[0].text
                 if xml_val != em[field]:
-                    date.xpath(field)[0].text = em[field]
-                    output += 'correction: changed pub '+field+' from '+xml_val+' to '+em[field]+'\n'
-                    output += 'warning: Pub date has been changed, make sure PDF pub date info matches XML\n'
+                    xpath(date, field)[0].text = em[field]
+                    report.correction('changed pub '+field+' from '+xml_val+' to '+em[field],
+                                      xpath(date, field)[0])
+                    report.warning('Pub date has been changed, make sure PDF pub date info matches XML')
     return root
 groomers.append(fix_pubdate)
 
 
 @register_validator
-def check_pubdate(root):
-    global output
-
+@read_only
+@front_matter
+def check_pubdate(root, report):
     #  Get EM Pubdate
-    doi = get_doi(root)
-    proc = subprocess.Popen(['php', '/var/local/scripts/production/getPubdate.php', doi], shell=False, stdout=subprocess.PIPE)
-    pubdate = proc.communicate()[0]
+    pubdate = pubdate_provider.lookup(get_doi(root))
     if not pubdate:
-        output += "error: EM has no pubdate for this article\n"
+        report.error("EM has no pubdate for this article")
         return root
     
     #  Get XML pubdate
-    epubs = root.xpath("//pub-date[@pub-type='epub']")
+    epubs = article_index(root).epub_dates
     if len(epubs) < 1:  # error on missing pubdate
-        output += "error: no epub date defined in xml\n"
+        report.error("no epub date defined in xml")
         return root
     elif len(epubs) > 1:  # error on > 1 pubdate
-        output += "error: more than one epub date defined in xml\n"
+        report.error("more than one epub date defined in xml")
         return root
 
     #  Parse XML pubdate
@@ -255,123 +992,134 @@ def check_pubdate(root):
     for field in ['year','month','day']:
         try:
             if field != 'year':
-                epub_date[field] = epub.xpath('./' + field)[0].text.zfill(2)
+                epub_date[field] = xpath(epub, './' + field)[0].text.zfill(2)
             else:
-                epub_date[field] = epub.xpath('./' + field)[0].text
+                epub_date[field] = xpath(epub, './' + field)[0].text
         except IndexError, e:
-            output +="error: missing field in xml epub date: %s\n" % field
+            report.error("missing field in xml epub date: %s" % field)
             return root
         
     xml_pubdate_str = "%(year)s-%(month)s-%(day)s" % epub_date
 
     #  Check that EM and XML pubdate match
     if xml_pubdate_str != pubdate:
-        output += ("error: pubdate defined in xml (%s) does not "
-                   "match EM pubdate (%s)\n" %
-                   (xml_pubdate_str,
-                   pubdate))
+        report.error("pubdate defined in xml (%s) does not "
+                     "match EM pubdate (%s)" %
+                     (xml_pubdate_str,
+                      pubdate))
 
     return root
 
 
-def fix_pub_date_elements(root):
+@reads('front')
+@tracks_changes
+def fix_pub_date_elements(root, report):
     '''
     Outer If statement in try: checks for 'collection' element. if
-    it exists, it removes 'month' child if exists in ONE articles.
+    it exists, it removes 'month' child if exists in journals without
+    collection months (PLoS ONE).
     Then it checks the year against epub's year.
     If 'collection' doesn't exist, the else: statement builds it and adds
     it in correct location.
     Last If statement checks for 'ppub' element, and removes it if it exists.
     '''
-    global output
-    year = get_singular_node(root, "//pub-date[@pub-type='epub']/year")
-    month = get_singular_node(root, "//pub-date[@pub-type='epub']/month")
-    if root.xpath("//pub-date[@pub-type='collection']"):
-        for coll in root.xpath("//pub-date[@pub-type='collection']"):
-            if get_singular_node(root, '//journal-title-group/journal-title').text == "PLoS ONE":
-                if coll.xpath('month'):
+    index = article_index(root)
+    year = singular(index.epub('year'), "//pub-date[@pub-type='epub']/year")
+    month = singular(index.epub('month'), "//pub-date[@pub-type='epub']/month")
+    journal = index.journal
+    colls = xpath(root, "//pub-date[@pub-type='collection']")
+    if colls:
+        for coll in colls:
+            if journal is not None and not journal.collection_month:
+                if xpath(coll, 'month'):
                     mo = get_singular_node(coll, 'month')
                     mo.getparent().remove(mo)
-                    output += 'correction: removed month from collection tag\n'
+                    report.correction('removed month from collection tag', coll)
             else:
                 pub_val = month.text
                 xml_val = get_singular_node(coll, 'month').text
                 if xml_val != pub_val:
                     get_singular_node(coll, 'month').text = pub_val
-                    output += 'correction: changed collection month from '\
-                              + xml_val + ' to ' + pub_val + '\n'
+                    report.correction('changed collection month from '
+                                      + xml_val + ' to ' + pub_val, get_singular_node(coll, 'month'))
 
-            if coll.xpath('year'):
+            if xpath(coll, 'year'):
                 pub_val = year.text
                 xml_val = get_singular_node(coll, 'year').text
                 if xml_val != pub_val:
                     get_singular_node(coll, 'year').text = pub_val
-                    output += 'correction: changed collection year from '\
-                              + xml_val + ' to ' + pub_val + '\n'
+                    report.correction('changed collection year from '
+                                      + xml_val + ' to ' + pub_val, get_singular_node(coll, 'year'))
     else:
-        for pubds in root.xpath("//article-meta"):
+        for pubds in xpath(root, "//article-meta"):
             col = etree.Element('pub-date')
             col.attrib['pub-type'] = 'collection'
             aunotes = get_singular_node(root, "//article-meta/author-notes")
             parent = aunotes.getparent()
             parent.insert(parent.index(aunotes) + 1, col)
             etree.SubElement(col, 'year').text = year.text
-            output += 'correction: added missing "collection" pub-type\n'
-    if root.xpath("//pub-date[@pub-type='ppub']"):
+            report.correction('added missing "collection" pub-type', parent)
+    if xpath(root, "//pub-date[@pub-type='ppub']"):
         ppub = get_singular_node(root, "//pub-date[@pub-type='ppub']")
+        report.touch(ppub.getparent())
         ppub.getparent().remove(ppub)
-        output+= 'correction: removed pub-date element with "ppub" type\n'
+        report.correction('removed pub-date element with "ppub" type')
     return root
 groomers.append(fix_pub_date_elements)
 
 
-def fix_volume(root):
-    global output
-    year = root.xpath("//pub-date[@pub-type='epub']/year")[0].text
-    journal = root.xpath("//journal-id[@journal-id-type='pmc']")[0].text
-    volumes = {'plosbiol':2002, 'plosmed':2003, 'ploscomp':2004, 'plosgen':2004,
-               'plospath':2004, 'plosone':2005, 'plosntds':2006}
-    for volume in root.xpath("//article-meta/volume"):
-        correct_volume = str(int(year) - volumes[journal])
+@reads('front')
+@tracks_changes
+def fix_volume(root, report):
+    index = article_index(root)
+    year = index.epub('year')[0].text
+    journal = index.journal
+    for volume in xpath(root, "//article-meta/volume"):
+        if journal is None or journal.founded is None:
+            raise ValueError("journal's first volume year is not in the vocabulary")
+        correct_volume = str(int(year) - journal.founded + 1)
         if volume.text != correct_volume:
             old_volume = volume.text
             volume.text = correct_volume
-            output += 'correction: changed volume from '+old_volume+' to '+volume.text+'\n'
-            output += 'warning: Volume has been changed, make sure PDF citation and footer info matches XML\n'
+            report.correction('changed volume from '+old_volume+' to '+volume.text, volume)
+            report.warning('Volume has been changed, make sure PDF citation and footer info matches XML')
     return root
 groomers.append(fix_volume)
 
 
-def fix_issue(root):
-    global output
-    month = root.xpath("//pub-date[@pub-type='epub']/month")[0].text
-    for issue in root.xpath("//article-meta/issue"):
+@reads('article-meta')
+@tracks_changes
+def fix_issue(root, report):
+    month = article_index(root).epub('month')[0].text
+    for issue in xpath(root, "//article-meta/issue"):
         if issue.text != month:
             old_issue = issue.text
             issue.text = month
-            output += 'correction: changed issue from '+old_issue+' to '+issue.text+'\n'
-            output += 'warning: Issue has been changed, make sure PDF citation and footer info matches XML\n'
+            report.correction('changed issue from '+old_issue+' to '+issue.text, issue)
+            report.warning('Issue has been changed, make sure PDF citation and footer info matches XML')
     return root
 groomers.append(fix_issue)
 
 
-def fix_copyright(root):
-    global output
-    year = root.xpath("//pub-date[@pub-type='epub']/year")[0].text
-    for copyright in root.xpath("//article-meta//copyright-year"):
+@reads('article-meta')
+@tracks_changes
+def fix_copyright(root, report):
+    year = article_index(root).epub('year')[0].text
+    for copyright in xpath(root, "//article-meta//copyright-year"):
         if copyright.text != year:
             old_copyright = copyright.text
             copyright.text = year
-            output += 'correction: changed copyright year from '\
-                      + old_copyright + ' to ' + copyright.text + '\n'
+            report.correction('changed copyright year from '
+                              + old_copyright + ' to ' + copyright.text, copyright)
     return root
 groomers.append(fix_copyright)
 
 
-def add_creative_commons_copyright_link(root):
-    global output
-    for statement in root.xpath("//permissions/license/license-p"):
-        if len(statement.xpath("ext-link")) == 0:
+@tracks_changes
+@dispatch_on('license-p', match=lambda node: has_parents(node, 'permissions/license'))
+def add_creative_commons_copyright_link(root, report, statements):
+    for statement in statements:
+        if len(xpath(statement, "ext-link")) == 0:
             if statement.text[30:36] == " distr":
                 l = etree.SubElement(statement, "ext-link")
                 l.attrib['ext-link-type'] = 'uri'
@@ -381,163 +1129,204 @@ def add_creative_commons_copyright_link(root):
                 l.tail = (', which permits unrestricted use, distribution, '
                           'and reproduction in any medium, provided the original '
                           'author and source are credited.')
-                for attr in root.xpath("//permissions/license"):
+                report.touch(statement)
+                for attr in xpath(root, "//permissions/license"):
                     attr.attrib['{http://www.w3.org/1999/xlink}href'] = 'http://creativecommons.org/licenses/by/4.0/'
+                    report.touch(attr)
             elif statement.text[30:36] == ", free":
                 pass
             else:
-                output += 'warning: License text was not recognized CC license, CC link not added\n'
+                report.warning('License text was not recognized CC license, CC link not added')
     return root
 groomers.append(add_creative_commons_copyright_link)
 
 
-def fix_elocation(root):
-    global output
+@reads('article-meta')
+@tracks_changes
+def fix_elocation(root, report):
     doi = get_doi(root)
     correct_eloc = 'e'+str(int(doi[-7:]))
-    elocs = root.xpath("//elocation-id")
+    elocs = xpath(root, "//elocation-id")
     for eloc in elocs:
         if eloc.text != correct_eloc:
             old_eloc = eloc.text
             eloc.text = correct_eloc
-            output += 'correction: changed elocation from '+old_eloc+' to '+eloc.text+'\n'
+            report.correction('changed elocation from '+old_eloc+' to '+eloc.text, eloc)
     if not elocs:
         eloc = etree.Element('elocation-id')
         eloc.text = correct_eloc
-        issue = root.xpath("//article-meta/issue")[0]
+        issue = xpath(root, "//article-meta/issue")[0]
         parent = issue.getparent()
         parent.insert(parent.index(issue) + 1, eloc)
-        output += 'correction: added missing elocation '+eloc.text+'\n'
+        report.correction('added missing elocation '+eloc.text, parent)
     return root
 groomers.append(fix_elocation)
 
 
-def fix_fpage_lpage_in_meta(root):
-    global output
+@reads('article-meta')
+@tracks_changes
+def fix_fpage_lpage_in_meta(root, report):
     changed = False
-    if root.xpath("//article-meta/fpage"):
+    if xpath(root, "//article-meta/fpage"):
         fp = get_singular_node(root, "//article-meta/fpage")
+        report.touch(fp.getparent())
         fp.getparent().remove(fp)
         changed = True
-    if root.xpath("//article-meta/lpage"):
+    if xpath(root, "//article-meta/lpage"):
         lp = get_singular_node(root, "//article-meta/lpage")
+        report.touch(lp.getparent())
         lp.getparent().remove(lp)
         changed = True
     if changed:
-        output += "correction: removed fpage/lpage tag(s) from article-meta\n"
+        report.correction("removed fpage/lpage tag(s) from article-meta")
     return root
 groomers.append(fix_fpage_lpage_in_meta)
 
 
-def fix_related_article(root):
-    global output
+@tracks_changes
+@dispatch_on('related-article')
+def fix_related_article(root, report, related):
     h = '{http://www.w3.org/1999/xlink}href'
-    related = root.xpath("//related-article")
     for link in related:
         if re.match(r'info:doi/[a-z]{4}\.[0-9]{7}', link.attrib[h]):
             old_link = link.attrib[h]
             link.attrib[h] = link.attrib[h].replace('info:doi/', 'info:doi/10.1371/journal.')
-            output += 'correction: changed related article link from '+old_link+' to '+link.attrib[h]+'\n'
+            report.correction('changed related article link from '+old_link+' to '+link.attrib[h], link)
     return root
 groomers.append(fix_related_article)
 
 
-def fix_title(root):
-    global output
-    for title in root.xpath("//title"):
-        title_str = etree.tostring(title)
-        if re.search(r'\s</title>', title_str):
-            title.getparent().replace(title, etree.fromstring(re.sub(r'\s*</title>', r'</title>', title_str)))
-            text = title.text if title.text else title.getchildren()[0].text+title.getchildren()[0].tail
-            output += 'correction: removed whitespace from end of title '+text+'\n'
+@tracks_changes
+@dispatch_on('title')
+def fix_title(root, report, titles):
+    for title in titles:
+        node, attribute = last_text(title)
+        old = rewrite_text(node, attribute, r'[ \t\n]+\Z', '')
+        if old is not None:
+            report.touch(title)
+            if title.tail is not None and not title.tail.strip():
+                title.tail = None
+                report.touch(title.getparent())
+            if node is title:
+                text = old
+            elif title.text:
+                text = title.text
+            else:
+                text = title[0].text + (old if title[0] is node else title[0].tail)
+            report.correction('removed whitespace from end of title '+text)
     return root
 groomers.append(fix_title)
 
 
-def fix_headed_title(root):
-    global output
-    for title in root.xpath("//sec[@sec-type='headed']/title"):
-        if re.search(r':$', title.text):
-            old_title = title.text
-            title.text = re.sub(r':$', r'', title.text)
-            output += 'correction: removed punctuation from headed title '+old_title+'\n'
+@reads('body-titles')
+@tracks_changes
+@dispatch_on('title', match=lambda node: has_parents(node, 'sec', {'sec-type': 'headed'}))
+def fix_headed_title(root, report, titles):
+    for title in titles:
+        old_title = rewrite_text(title, 'text', r':$', '')
+        if old_title is not None:
+            report.correction('removed punctuation from headed title '+old_title, title)
     return root
 groomers.append(fix_headed_title)
 
 
-def fix_formula(root):
-    global output
-    for formula in root.xpath("//fig//caption//disp-formula") + root.xpath("//table//disp-formula"):
+@tracks_changes
+def fix_formula(root, report):
+    for formula in xpath(root, "//fig//caption//disp-formula") + xpath(root, "//table//disp-formula"):
         formula.tag = 'inline-formula'
         formula.attrib.pop('id')
-        graphic = formula.xpath("graphic")[0]
+        graphic = xpath(formula, "graphic")[0]
         graphic.tag = 'inline-graphic'
         graphic.attrib.pop('position')
-        output += 'correction: changed disp-formula to inline-formula for '\
-                  +graphic.attrib['{http://www.w3.org/1999/xlink}href']+'\n'
+        report.correction('changed disp-formula to inline-formula for '
+                          +graphic.attrib['{http://www.w3.org/1999/xlink}href'], formula.getparent())
     return root
 groomers.append(fix_formula)
 
 
-def fix_formula_label(root):
-    global output
-    for label in root.xpath("//disp-formula/label"):
+def fix_formula_label(root, report):
+    for label in xpath(root, "//disp-formula/label"):
         old_label = label.text
         label.text = re.sub(r'[^0-9]*([0-9]\w*|[A-Z]).*', r'(\1)', label.text)
         if label.text != old_label:
-            output += 'correction: changed disp-formula label from '+old_label+' to '+label.text+'\n'
+            report.correction('changed disp-formula label from '+old_label+' to '+label.text)
     return root
 #groomers.append(fix_formula_label)
 
 
-def fix_label(root):
-    global output
+@reads('ref-list')
+@tracks_changes
+@dispatch_on('label', match=lambda node: has_parents(node, 'ref'))
+def fix_label(root, report, labels):
     refnums = ''
-    for label in root.xpath("//ref/label"):
+    for label in labels:
+        if len(label):
+            report.touch(label)
         for item in list(label.iterdescendants()):
             etree.strip_tags(label, item.tag)
             if label.text:
                 refnums += label.text+' '
     if refnums:
-        output += 'correction: removed tags inside reference labels '+refnums+'\n'
+        report.correction('removed tags inside reference labels '+refnums)
     return root
 groomers.append(fix_label)
 
 
-def fix_url(root):
-    global output
+@memoize(4096)
+def normalize_link(href, link_type):
+    """Return (href, prefixed, fixes) for an ext-link's href and
+    ext-link-type: the href without whitespace, with http:// added if it
+    has no scheme and with the dx.doi.org or PubMed address added to DOIs
+    and PMIDs; the href as it was once http:// was added, or None if it was
+    not; and how many DOI and PMID addresses were added.
+    """
+    href = re.sub(r'\s', r'', href)
+    prefixed = None
+    fixes = 0
+    if not href.startswith('http') and not href.startswith('ftp'):
+        href = prefixed = 'http://' + href
+    if re.match(r'http://10\.[0-9]{4}', href):
+        href = href.replace('http://', 'http://dx.doi.org/')
+        fixes += 1
+    if re.match(r'http://[0-9]{7,8}$', href) or link_type == 'pmid':
+        href = href.replace('http://', 'http://www.ncbi.nlm.nih.gov/pubmed/')
+        fixes += 1
+    elif link_type is None:
+        raise KeyError('ext-link-type')
+    return href, prefixed, fixes
+
+
+@tracks_changes
+@dispatch_on('ext-link')
+def fix_url(root, report, links):
     h = '{http://www.w3.org/1999/xlink}href'
     correction_count = 0
-    for link in root.xpath("//ext-link"):
+    for link in links:
         old_link = link.attrib[h]
-        # remove whitespace
-        if re.search(r'\s', link.attrib[h]):
-            link.attrib[h] = re.sub(r'\s', r'', link.attrib[h])
-        # prepend http:// if not there
-        if not link.attrib[h].startswith('http') and not link.attrib[h].startswith('ftp'):
-            link.attrib[h] = 'http://' + link.attrib[h]
-            output += 'correction: changed link from '+old_link+' to '+link.attrib[h]+'\n'
-        # prepend dx.doi.org/ for doi
-        if re.match(r'http://10\.[0-9]{4}', link.attrib[h]):
-            link.attrib[h] = link.attrib[h].replace('http://', 'http://dx.doi.org/')
-            correction_count += 1
-        # prepend www.ncbi.nlm.nih.gov/pubmed/ for pmid
-        if re.match(r'http://[0-9]{7,8}$', link.attrib[h]) or link.attrib['ext-link-type'] == 'pmid':
-            link.attrib[h] = link.attrib[h].replace('http://', 'http://www.ncbi.nlm.nih.gov/pubmed/')
-            correction_count += 1
-    
+        new_link, prefixed, fixes = normalize_link(old_link, link.get('ext-link-type'))
+        if prefixed is not None:
+            report.correction('changed link from '+old_link+' to '+prefixed)
+        correction_count += fixes
+        if new_link != old_link:
+            link.attrib[h] = new_link
+            report.touch(link)
+
     if correction_count > 0:
-        output += "correction: fixed %i doi/pmid link(s).\n" % correction_count
+        report.correction("fixed %i doi/pmid link(s)." % correction_count)
     return root
 groomers.append(fix_url)
 
 
-def fix_page_range(root):
-    global output
-    for ref in root.xpath("//ref/mixed-citation"):
-        fpages = ref.xpath("fpage")
-        lpages = ref.xpath("lpage")
-        refnum = ref.getparent().xpath("label")[0].text if len(fpages) > 1 or len(lpages) > 1 else ''
+@reads('ref-list')
+@tracks_changes
+@dispatch_on('mixed-citation', match=lambda node: has_parents(node, 'ref'))
+def fix_page_range(root, report, citations):
+    for ref in citations:
+        fpages = xpath(ref, "fpage")
+        lpages = xpath(ref, "lpage")
+        refnum = xpath(ref.getparent(), "label")[0].text if len(fpages) > 1 or len(lpages) > 1 else ''
+        if len(fpages) > 1 or len(lpages) > 1:
+            report.touch(ref)
         if len(fpages) > 1:
             fpages[0].text = min([x.text for x in fpages + lpages])
             for page in fpages[1:]:
@@ -548,168 +1337,283 @@ def fix_page_range(root):
                 ref.remove(page)
             lpages[0].tail = lpages[0].tail.replace(',','.')
         if refnum:
-            output += 'correction: consolidated multiple fpage-lpage in reference '+refnum+'\n'
+            report.correction('consolidated multiple fpage-lpage in reference '+refnum)
     return root
 groomers.append(fix_page_range)
 
 
-def fix_comment(root):
-    global output
+@reads('ref-list', 'comments')
+@tracks_changes
+@dispatch_on('comment')
+def fix_comment(root, report, comments):
     refnums = ''
-    for comment in root.xpath("//comment"):
+    for comment in comments:
         if comment.tail and comment.tail.startswith("."):
             comment.tail = re.sub(r'^\.', r'', comment.tail)
-            refnums += list(comment.iterancestors("ref"))[0].xpath("label")[0].text+' '
+            report.touch(comment.getparent())
+            refnums += xpath(list(comment.iterancestors("ref"))[0], "label")[0].text+' '
     if refnums:
-        output += 'correction: removed period after comment end tag in journal references '+refnums+'\n'
+        report.correction('removed period after comment end tag in journal references '+refnums)
     return root
 groomers.append(fix_comment)
 
 
-def fix_provenance(root):
-    global output
-    for prov in root.xpath("//author-notes//fn[@fn-type='other']/p/bold"):
+@reads('article-meta', 'ref-list')
+@tracks_changes
+def fix_provenance(root, report):
+    for prov in xpath(root, "//author-notes//fn[@fn-type='other']/p/bold"):
         if prov.text == 'Provenance:':
             fngroup = etree.Element('fn-group')
+            report.touch(prov.getparent().getparent().getparent())
             fngroup.append(prov.getparent().getparent())
-            reflist = root.xpath("//ref-list")[0]
+            reflist = xpath(root, "//ref-list")[0]
             parent = reflist.getparent()
             parent.insert(parent.index(reflist) + 1, fngroup)
-            output += 'correction: moved provenance from author-notes to fn-group after references\n'
+            report.correction('moved provenance from author-notes to fn-group after references', parent)
     return root
 groomers.append(fix_provenance)
 
 
-def fix_remove_si_label_punctuation(root):
-    global output
+@reads('supplementary-material')
+@tracks_changes
+@dispatch_on('label', match=lambda node: has_parents(node, 'supplementary-material'))
+def fix_remove_si_label_punctuation(root, report, labels):
     changed = False
-    for lab in root.xpath("//supplementary-material/label"):
+    for lab in labels:
         stripped = lab.text.strip(string.whitespace + string.punctuation)
         if lab.text != stripped:
             lab.text = stripped
+            report.touch(lab)
             changed = True
     if changed:
-        output += 'correction: removed punctuation from end of label tag text'
+        report.correction('removed punctuation from end of label tag text')
     return root
 groomers.append(fix_remove_si_label_punctuation)
 
 
-def fix_extension(root):
-    global output
-    for si in root.xpath("//supplementary-material"):
-        typ = si.xpath("caption/p")[-1].text
+@reads('supplementary-material')
+@tracks_changes
+@dispatch_on('supplementary-material')
+def fix_extension(root, report, supp_info):
+    for si in supp_info:
+        typ = xpath(si, "caption/p")[-1].text
         if re.match(r'^\(.*\)$', typ):
             filename = si.attrib['{http://www.w3.org/1999/xlink}href']
             ext = typ.strip('()').lower()
             if re.match(r's[0-9]{3}', filename[-4:]):
                 si.attrib['{http://www.w3.org/1999/xlink}href'] = filename+'.'+ext
-                output += 'correction: set extension of '\
-                          +filename+' to '+ext+' for '+si.xpath("label")[0].text+'\n'
+                report.correction('set extension of '
+                                  +filename+' to '+ext+' for '+xpath(si, "label")[0].text, si)
     return root
 groomers.append(fix_extension)
 
 
-def fix_mimetype(root):
-    global output
-    for si in root.xpath("//supplementary-material"):
-        typ = si.xpath("caption/p")[-1].text
+@reads('supplementary-material')
+@tracks_changes
+@dispatch_on('supplementary-material')
+def fix_mimetype(root, report, supp_info):
+    for si in supp_info:
+        typ = xpath(si, "caption/p")[-1].text
         if re.match(r'^\(.*\)$', typ):
             mime, enc = mimetypes.guess_type('x.'+typ.strip('()').lower(), False)
             if mime and ('mimetype' not in si.attrib or mime != si.attrib['mimetype']):
                 si.attrib['mimetype'] = mime
-                output += 'correction: set mimetype of '\
-                          +typ+' to '+mime+' for '+si.xpath("label")[0].text+'\n'
+                report.correction('set mimetype of '
+                                  +typ+' to '+mime+' for '+xpath(si, "label")[0].text, si)
     return root
 groomers.append(fix_mimetype)
 
 
-def remove_pua_set(char_stream):
-    global output
-    pua_set = ur'[\uE000-\uF8FF]'
+class CharStreamRule(object):
+    """A char stream groomer made of a regex and a message for each match.
+
+    message(char_stream, start) words the finding for a match at start.
+    Matches of a rule with delete set are removed from the stream.  Calling
+    a rule grooms a stream with that rule alone; scan_char_stream runs any
+    number of rules in one pass.  byte_pattern, if given, matches at least
+    wherever pattern would in the UTF-8 encoded stream, so that an article
+    can be checked for work before it is decoded.
+    """
+
+    def __init__(self, pattern, severity, message, delete=False, byte_pattern=None):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.byte_pattern = byte_pattern
+        self.severity = severity
+        self.message = message
+        self.delete = delete
+        self.__name__ = message.__name__
+
+    def __call__(self, char_stream, report):
+        return scan_char_stream(char_stream, report, [self])
+
+
+def char_stream_rule(pattern, severity, delete=False, byte_pattern=None):
+    def decorator(message):
+        return CharStreamRule(pattern, severity, message, delete, byte_pattern)
+    return decorator
+
+
+def match_context(char_stream, pos, display_width=20):
+    """Return the text just before and after pos, for showing a match."""
+    start = pos - display_width
+    if (start < 0): start = 0
+    end = pos + display_width
+    if (end >= len(char_stream)): start = -1
+    return char_stream[start:pos], char_stream[pos:end]
+
+
+_scanners = {}
+
+
+def rule_scanner(rules):
+    """Return one regex matching any of rules, naming its groups r0, r1..."""
+    scanner = _scanners.get(rules)
+    if scanner is None:
+        scanner = _scanners[rules] = re.compile(
+            '|'.join('(?P<r%d>%s)' % (i, rule.pattern) for i, rule in enumerate(rules)))
+    return scanner
+
 
-    # form correction output
-    display_width = 20
-    for m in re.finditer(pua_set, char_stream):
-        start = m.start() - display_width
-        if (start < 0): start = 0
-        end = m.start() + display_width
-        if (end >= len(char_stream)): start = -1
-        output += "correction: removed bad character at index=%s " \
-                  "(marked by ^): \"%s^%s\"\n" \
-                  % (m.start(), char_stream[start:m.start()], char_stream[m.start():end])
+def scan_char_stream(char_stream, report, rules):
+    """Run char stream rules over char_stream in a single scan.
 
-    # actually make the corrections
-    char_stream = re.sub(pua_set, '', char_stream)
+    The rule patterns are combined into one regex, and every match is
+    collected in one pass; deletions are then applied with a single join.
+    Findings come out rule by rule in the order given, just as if each rule
+    had run in turn with the deleting ones first.  A deleting rule still
+    catches matches inside another rule's match.  When anything was
+    deleted, the other rules are matched again against the groomed stream,
+    since a deletion can make or break their matches.
+    """
+    rules = tuple(rules)
+    deleting = [i for i, rule in enumerate(rules) if rule.delete]
+
+    matches = [[] for rule in rules]
+    for m in rule_scanner(rules).finditer(char_stream):
+        i = int(m.lastgroup[1:])
+        matches[i].append(m.span())
+        if m.end() - m.start() > 1:
+            for j in deleting:
+                if j != i:
+                    matches[j].extend(n.span() for n in rules[j].regex.finditer(char_stream, m.start(), m.end()))
+
+    deletions = sorted(set(span for i in deleting for span in matches[i]))
+    if deletions:
+        pieces = []
+        pos = 0
+        for start, end in deletions:
+            pieces.append(char_stream[pos:start])
+            pos = end
+        pieces.append(char_stream[pos:])
+        groomed = ''.join(pieces)
+        kept = [i for i, rule in enumerate(rules) if not rule.delete]
+        for i in kept:
+            matches[i] = []
+        if kept:
+            for m in rule_scanner(tuple(rules[i] for i in kept)).finditer(groomed):
+                matches[kept[int(m.lastgroup[1:])]].append(m.span())
+    else:
+        groomed = char_stream
+
+    for rule, spans in zip(rules, matches):
+        report.groomer = rule.__name__
+        for start, end in sorted(spans):
+            message = rule.message(char_stream if rule.delete else groomed, start)
+            report.add(rule.severity, message)
+    return groomed
+
+
+_byte_scanners = {}
 
-    return char_stream
-char_stream_groomers.append(remove_pua_set)
+
+def needs_char_scan(data, rules):
+    """Tell whether any rule may match in data, a UTF-8 buffer.
+
+    Searches the raw bytes with the rules' byte patterns, so articles with
+    nothing to groom need not be decoded.  Rules without a byte pattern
+    always need the scan.
+    """
+    rules = tuple(rules)
+    if any(rule.byte_pattern is None for rule in rules):
+        return True
+    scanner = _byte_scanners.get(rules)
+    if scanner is None:
+        scanner = _byte_scanners[rules] = re.compile('|'.join(rule.byte_pattern for rule in rules))
+    return scanner.search(data) is not None
+
+
+def check_utf8(data, chunk_size=1 << 20, final=True):
+    """Raise UnicodeDecodeError unless data is valid UTF-8, a chunk at a time.
+    Unless final, data may end partway through a character.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for pos in xrange(0, len(data), chunk_size):
+        decoder.decode(data[pos:pos + chunk_size])
+    if final:
+        decoder.decode('', True)
 
 
 @register_char_stream_groom
-def alert_merops_validator_error(char_stream):
-    global output
-    merops_error_re = ur'\[!.{0,100}!\]'
-    display_width = 20
-    for m in re.finditer(merops_error_re, char_stream):
-        start = m.start() - display_width
-        if (start < 0): start = 0
-        end = m.start() + display_width
-        if (end >= len(char_stream)): start = -1
-        output += ("error: located merops-inserted validation error, "
-                   "please address and remove: \"%s%s\"\n" %
-                   (char_stream[start:m.start()],
-                    char_stream[m.start():end]))
-
-    return char_stream
+@char_stream_rule(ur'[\uE000-\uF8FF]', 'correction', delete=True,
+                  byte_pattern=r'\xEE[\x80-\xBF][\x80-\xBF]|\xEF[\x80-\xA3][\x80-\xBF]')
+def remove_pua_set(char_stream, start):
+    before, after = match_context(char_stream, start)
+    return "removed bad character at index=%s (marked by ^): \"%s^%s\"" % (start, before, after)
+
+
+@register_char_stream_groom
+@char_stream_rule(ur'\[!.{0,100}!\]', 'error', byte_pattern=r'\[!.{0,400}!\]')
+def alert_merops_validator_error(char_stream, start):
+    before, after = match_context(char_stream, start)
+    return ("located merops-inserted validation error, "
+            "please address and remove: \"%s%s\"" % (before, after))
 
 
 @register_groom
-def check_article_type(root):
-    global output
-    article_types = ["Book Review","Book Review/Science in the Media","Community Page","Debate","Editorial",
-                     "Education","Essay","Expert Commentary","Expression of Concern","Feature","From Innovation to Application",
-                     "Guidelines and Guidance","Health in Action","Historical Profiles and Perspectives",
-                     "Historical and Philosophical Perspectives","History/Profile","Interview","Journal Club","Learning Forum",
-                     "Message from ISCB","Message from PLoS","Neglected Diseases","Obituary","Online Only: Editorial","Opinion",
-                     "Overview","Perspective","Pearls","Photo Quiz","Policy Forum","Policy Platform","Primer","Reader Poll",
-                     "Research Article","Research in Translation","Review","Special Report","Symposium","Synopsis",
-                     "Technical Report","The PLoS Medicine Debate","Unsolved Mystery","Viewpoints", "Correction", "Retraction",
-                     "Formal Comment", "Collection Review", "Topic Page"]
-    for typ in root.xpath("//article-categories//subj-group[@subj-group-type='heading']/subject"):
+@reads('article-meta', 'journal-meta')
+@read_only
+@dispatch_on('subject', match=lambda node: has_parents(node, 'subj-group', {'subj-group-type': 'heading'})
+                                          and has_ancestor(node, 'article-categories'))
+def check_article_type(root, report, subjects):
+    article_types = vocabulary.article_types_for(article_index(root).journal)
+    for typ in subjects:
         if typ.text not in article_types:
-            output += 'error: '+typ.text+' is not a valid article type\n'
+            report.error(typ.text+' is not a valid article type')
     return root
 
 
 @register_groom
-def check_misplaced_pullquotes(root):
-    global output
-    pull_quote_placed_last = root.xpath('//body/sec/p[last()]/named-content[@content-type="pullquote"]')
+@read_only
+def check_misplaced_pullquotes(root, report):
+    pull_quote_placed_last = xpath(root, '//body/sec/p[last()]/named-content[@content-type="pullquote"]')
     if (pull_quote_placed_last):
-        output += 'warning: pullquote appears as last element of a section\n'
+        report.warning('pullquote appears as last element of a section')
     return root
 
 
 @register_groom
-def check_missing_blurb(root):
-    global output
-    journal = root.xpath("//journal-id[@journal-id-type='pmc']")[0].text
-
-    blurb_journals = ['plosmed', 'plosbio']
-    if journal in blurb_journals:
-        abstract_toc = root.xpath('//article/front/article-meta/abstract[@abstract-type="toc"]')
+@reads('front')
+@applies_to(journals=lambda vocabulary: vocabulary.blurb_journals)
+@read_only
+def check_missing_blurb(root, report):
+    journal = article_index(root).journal
+
+    if journal is not None and journal.blurb:
+        abstract_toc = xpath(root, '//article/front/article-meta/abstract[@abstract-type="toc"]')
         if not abstract_toc:
-            output += "warning: article xml is missing 'blurb'\n"
+            report.warning("article xml is missing 'blurb'")
     return root
 
 
 @register_groom
-def check_SI_attributes(root):
-    global output
+@reads('supplementary-material', 'article-meta')
+@read_only
+@dispatch_on('supplementary-material', match=lambda node: has_parents(node, 'article/body/sec'))
+def check_SI_attributes(root, report, supp_info):
+    doi = article_index(root).doi_suffix
 
-    doi = get_doi(root).split('10.1371/journal.')[1]
-
-    for si in root.xpath("//article/body/sec/supplementary-material"):
+    for si in supp_info:
         mimetype = si.get("mimetype")
         label = si.find("label")
         si_id = si.get("id")
@@ -717,201 +1621,1198 @@ def check_SI_attributes(root):
         #TODO: was href hash built here.  Need replacement
 
         if not mimetype:
-            output += "error: mimetype missing: %s!\n" % si_id
+            report.error("mimetype missing: %s!" % si_id)
 
         good_href_pattern = re.compile(r'%s\.[a-z0-9]+' % si_id)
         if not good_href_pattern.match(href):
-            output += "error: bad or missing file extension: %s\n" % href
+            report.error("bad or missing file extension: %s" % href)
 
         doi_pattern = re.compile(r'%s' % doi)
         if not doi_pattern.match(href) or not doi_pattern.match(si_id):
-            output += "error: supp info %s does not match doi: %s\n" % (href, doi)
+            report.error("supp info %s does not match doi: %s" % (href, doi))
 
     return root
 
 
 @register_groom
-def check_lowercase_extensions(root):
-    global output
-
+@read_only
+def check_lowercase_extensions(root, report):
     for graphic in root.findall('graphic'):
         href = graphic.attrib['{http://www.w3.org/1999/xlink}href']
         if not re.match(r'.+?\.[gte][0-9]{3,4}\.[a-z0-9]+', href):
-            output += "error: bad or missing file extension: %s\n" % href
+            report.error("bad or missing file extension: %s" % href)
 
     return root
 
 
 @register_groom
-def check_collab_markup(root):
-    global output
-
-    suspicious_pattern = "\S*\s\S*\s\S*\s\S*|\sthe\s|\sfor\s|\sof\s|\son\s|\sin\s|\swith\s|\sgroup\s|\scenter|\sorganization|\sorganizing|\scollaboration|\scollaborative\s|\scommittee|\scouncil|\sconsortium|\sassociation|\spartnership|\sproject|\steam|\ssociety\s"
-
-    authors_names = root.xpath('//contrib[@contrib-type="author"]/name/surname | //contrib[@contrib-type="author"]/name/given-name')
+@reads('contribs')
+@read_only
+@dispatch_on('surname', 'given-name', match=lambda node: has_parents(node, 'contrib/name')
+                                                       and node.getparent().getparent().get('contrib-type') == 'author')
+def check_collab_markup(root, report, authors_names):
     for name in authors_names:
-        if re.search(suspicious_pattern, name.text, re.IGNORECASE):
-            output += "warning: Article may contain incorrect markup for a " \
-                      "collaborative author. Suspicious text to search for: " \
-                      "%s\n" % name.text
+        if looks_like_collab(name.text):
+            report.warning("Article may contain incorrect markup for a "
+                           "collaborative author. Suspicious text to search for: "
+                           "%s" % name.text)
 
     return root
 
 
 @register_groom
-def check_collab_children(root):
-    global output
-
-    for collab in root.xpath('//contrib-group/contrib/collab'):
-        if collab.xpath('contrib-group'):
-            output+= 'warning: Collab "%s" includes a nested contrib-group. ' \
-                      'This may be causing erroneous authors to appear after the ' \
-                      'collab in the rendered byline.\n' % collab.text
+@reads('contribs')
+@read_only
+@dispatch_on('collab', match=lambda node: has_parents(node, 'contrib-group/contrib'))
+def check_collab_children(root, report, collabs):
+    for collab in collabs:
+        if xpath(collab, 'contrib-group'):
+            report.warning('Collab "%s" includes a nested contrib-group. '
+                           'This may be causing erroneous authors to appear after the '
+                           'collab in the rendered byline.' % collab.text)
     return root
 
 
 #@register_groom
-def check_on_behalf_of_markup(root):
-    global output
-
-    suspicious_words = ['for', 'on behalf of']
-    for collab in root.xpath('//contrib-group/contrib/collab'):
-        for word in suspicious_words:
-            if re.match(word, collab.text, re.IGNORECASE):
-                output += "warning: <collab> tag with value: %s.  " \
-                          "There may be a missing <on-behalf-of>.\n" % collab.text
-                break
+@reads('contribs')
+@read_only
+def check_on_behalf_of_markup(root, report):
+    for collab in xpath(root, '//contrib-group/contrib/collab'):
+        if ascii_lower(collab.text).startswith(ON_BEHALF_OF_PREFIXES):
+            report.warning("<collab> tag with value: %s.  "
+                           "There may be a missing <on-behalf-of>." % collab.text)
 
     return root
 
 
 @register_groom
-def check_sec_ack_title(root):
-    global output
-
-    for fake_ack in root.xpath('//sec/title[text()="Acknowledgements"]'):
-        output += "warning: there is a <sec> titled \'Acknowledgements\' " \
-                  "rather than the use of an <ack> tag.\n"
+@reads('body-titles')
+@read_only
+@dispatch_on('title', match=lambda node: has_parents(node, 'sec')
+                                        and 'Acknowledgements' in [node.text] + [child.tail for child in node])
+def check_sec_ack_title(root, report, titles):
+    for fake_ack in titles:
+        report.warning("there is a <sec> titled \'Acknowledgements\' "
+                       "rather than the use of an <ack> tag.")
 
     return root
 
 
 @register_groom
-def check_improper_children_in_funding_statement(root):
-    global output
-
+@reads('article-meta')
+@read_only
+@dispatch_on('funding-statement')
+def check_improper_children_in_funding_statement(root, report, funding_statements):
     invalid_tags = ['inline-formula', 'inline-graphic']
-    for funding_statement in root.xpath('//funding-statement'):
+    for funding_statement in funding_statements:
         for elem in funding_statement:
             if elem.tag in invalid_tags:
-                output += "error: funding-statement has illegal child node: %s\n" % elem.tag
+                report.error("funding-statement has illegal child node: %s" % elem.tag)
 
     return root
 
 
 @register_groom
-def check_nlm_ta(root):
-    global output
-    nlm_tas = ["PLoS Biol", "PLoS Comput Biol", "PLoS Clin Trials",
-               "PLoS Genet", "PLoS Med", "PLoS Negl Trop Dis", "PLoS One",
-               "PLoS ONE", "PLoS Pathog", "PLoS Curr"]
-    nlm_ta = root.xpath("//journal-meta/journal-id[@journal-id-type='nlm-ta']")
+@reads('journal-meta')
+@read_only
+def check_nlm_ta(root, report):
+    nlm_ta = xpath(root, "//journal-meta/journal-id[@journal-id-type='nlm-ta']")
     if not nlm_ta:
-        output += 'error: missing nlm-ta in metadata\n'
-    elif nlm_ta[0].text not in nlm_tas:
-        output += 'error: invalid nlm-ta in metadata: '+nlm_ta[0].text+'\n'
+        report.error('missing nlm-ta in metadata')
+    elif nlm_ta[0].text not in vocabulary.nlm_tas:
+        report.error('invalid nlm-ta in metadata: '+nlm_ta[0].text)
     return root
 groomers.append(check_nlm_ta)
 
 
 @register_groom
-def check_valid_journal_title(root):
-    global output
-
-    valid_journal_titles = ["PLoS Biology", "PLoS Computational Biology",
-                            "PLoS Clinical Trials", "PLoS Genetics",
-                            "PLoS Medicine", "PLoS Neglected Tropical Diseases",
-                            "PLoS ONE", "PLoS Pathogens", "PLoS Currents"]
-    journal_title = root.xpath('/article/front/journal-meta/journal-title-group/journal-title')
+@reads('journal-meta')
+@read_only
+def check_valid_journal_title(root, report):
+    journal_title = xpath(root, '/article/front/journal-meta/journal-title-group/journal-title')
 
     if not journal_title:
-        output += "error: missing journal title in metadata\n"
-    elif journal_title[0].text not in valid_journal_titles:
-        output += "error: invalid journal title in metadata: %s\n" % journal_title[0].text
+        report.error("missing journal title in metadata")
+    elif journal_title[0].text not in vocabulary.journal_titles:
+        report.error("invalid journal title in metadata: %s" % journal_title[0].text)
 
     return root
 
 @register_groom
-def check_editor_affiliation(root):
-    global output
+@reads('article-meta')
+@read_only
+def check_editor_affiliation(root, report):
     aff = get_singular_node(root, "//aff[@id='edit1']/addr-line")
     regex = "taiwan, province of china"
     if re.search(regex, aff.text.lower()):
-        output += "error: Remove 'Province of China' from Editor address in XML and PDF\n"
+        report.error("Remove 'Province of China' from Editor address in XML and PDF")
 
     return root
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser("xmlgroomer.py before.xml after.xml\ndry run: xmlgroomer.py before.xml")
-    parser.add_argument("-e", "--error-check", action='store_true')
-    parser.add_argument("beforexml")
-    parser.add_argument("afterxml", nargs='?')
-    args = parser.parse_args()
+LOG_PATH = '/var/local/scripts/production/xmlgroomer/log/log'
+CACHE_PATH = '/var/local/scripts/production/xmlgroomer/cache'
+HISTORY_PATH = '/var/local/scripts/production/xmlgroomer/history'
 
-    dry_run = (len(sys.argv) == 2)
-    log = open('/var/local/scripts/production/xmlgroomer/log/log', 'a')
-    log.write('-'*50 + '\n'+time.strftime("%Y-%m-%d %H:%M:%S   "))
 
+class Profile(object):
+    """Per-stage timings and counters, summed over every article in a run.
+
+    Bracket each stage with start(report) and stop(name, started, report).
+    A stage counts as mutating when it touched elements, left the tree
+    untracked or emitted a correction.  Profiles from several processes
+    combine with merge().
+    """
+
+    columns = ['calls', 'wall', 'cpu', 'findings', 'mutated', 'xpaths', 'hits', 'memo_hits', 'memo_misses']
+
+    def __init__(self):
+        self.stats = collections.OrderedDict()
+
+    def start(self, report):
+        return (time.time(), time.clock(), len(report.findings), len(report.touched), report.untracked,
+                sum(xpath.counts.itervalues()), sum(xpath.hits.itervalues()),
+                sum(cache.hits for cache in memoized), sum(cache.misses for cache in memoized))
+
+    def stop(self, name, started, report):
+        wall, cpu, findings, touched, untracked, xpaths, hits, memo_hits, memo_misses = started
+        new_findings = report.findings[findings:]
+        mutated = (len(report.touched) > touched or report.untracked > untracked
+                   or any(f.severity == 'correction' for f in new_findings))
+        self.add(name, {'calls': 1,
+                        'wall': time.time() - wall,
+                        'cpu': time.clock() - cpu,
+                        'findings': len(new_findings),
+                        'mutated': int(mutated),
+                        'xpaths': sum(xpath.counts.itervalues()) - xpaths,
+                        'hits': sum(xpath.hits.itervalues()) - hits,
+                        'memo_hits': sum(cache.hits for cache in memoized) - memo_hits,
+                        'memo_misses': sum(cache.misses for cache in memoized) - memo_misses})
+
+    def add(self, name, counts):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = dict.fromkeys(self.columns, 0)
+        for column in self.columns:
+            stats[column] += counts[column]
+
+    def merge(self, other):
+        for name, counts in other.stats.items():
+            self.add(name, counts)
+
+    def render(self):
+        """Return a table of the stages, slowest first."""
+        lines = ['%-45s %7s %10s %10s %9s %8s %9s %9s %10s %11s'
+                 % ('stage', 'calls', 'wall ms', 'cpu ms', 'findings', 'mutated', 'xpaths', 'hits',
+                    'memo hits', 'memo misses')]
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1]['wall']):
+            lines.append('%-45s %7d %10.1f %10.1f %9d %8d %9d %9d %10d %11d'
+                         % (name, stats['calls'], stats['wall'] * 1000, stats['cpu'] * 1000,
+                            stats['findings'], stats['mutated'], stats['xpaths'], stats['hits'],
+                            stats['memo_hits'], stats['memo_misses']))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        return json.dumps(self.stats, indent=2)
+
+
+def may_have_changed(groomer, findings, failed):
+    """Tell whether a run of groomer that emitted findings may have changed
+    the tree, trusting groomers with regions to report changes (see reads).
+    """
+    if getattr(groomer, 'read_only', False):
+        return False
+    return (failed or getattr(groomer, 'regions', None) is None
+            or any(finding.severity == 'correction' for finding in findings))
+
+
+def run_groomers(root, groomer_list, report, log, report_errors=False, profile=None, history=None):
+    """Run each groomer over root in order, isolating their failures.
+
+    Consecutive dispatched groomers (see dispatch_on) share one walk of the
+    tree.  A failing groomer is logged (and, with report_errors, reported as
+    an error finding) and the run continues with the next one.  Each groomer
+    and shared walk is recorded in profile, if given.  Groomers that do not
+    apply to the article are left out and listed in report.skipped (see
+    applies_to); with an ArticleHistory, those whose regions are unchanged
+    reuse their last findings.  Queries from root share a QueryCache.  The
+    read_only groomers at the end run at once (see run_checks), unless the
+    run is profiled, since each stage is then timed on its own.
+    """
+    groomer_list, skipped = pipeline(groomer_list, *article_index(root).kind())
+    report.skipped.extend(skipped)
+    queries = _local.queries = QueryCache(root, report)
     try:
-        f = open(args.beforexml, 'r')
-    except IOError, e:
-        log.write(e.message)
-        log.close()
-        sys.exit(e)
-        
-    # Read file into a char stream and groom it
-    char_stream = f.read().decode('utf-8')#.decode('utf-8')
-    f.close()
+        return run_groomer_list(root, groomer_list, report, log, report_errors, profile, history, queries)
+    finally:
+        _local.queries = None
+
+
+def run_groomer_list(root, groomer_list, report, log, report_errors, profile, history, queries):
+    checks = len(groomer_list)
+    while checks > 0 and getattr(groomer_list[checks - 1], 'read_only', False):
+        checks -= 1
+    concurrent = profile is None and check_threads > 1 and len(groomer_list) - checks > 1
+    end = checks if concurrent else len(groomer_list)
+    i = 0
+    while i < end:
+        run = [groomer_list[i]]
+        nodes = [None]
+        if hasattr(groomer_list[i], 'tags'):
+            while i + len(run) < end and hasattr(groomer_list[i + len(run)], 'tags'):
+                run.append(groomer_list[i + len(run)])
+            if profile is not None:
+                started = profile.start(report)
+            nodes = collect_nodes(root, run)
+            if profile is not None:
+                profile.stop('collect_nodes', started, report)
+        for groomer, groomer_nodes in zip(run, nodes):
+            report.groomer = groomer.__name__
+            if profile is not None:
+                started = profile.start(report)
+            fingerprint = history.fingerprint(root, groomer) if history is not None else None
+            if fingerprint is None or not history.reuse(groomer, fingerprint, report):
+                findings = len(report.findings)
+                root, error = call_groomer(groomer, root, report, groomer_nodes)
+                failed = error is not None
+                if failed:
+                    report_failure(groomer, error, report, log, report_errors)
+                if may_have_changed(groomer, report.findings[findings:], failed):
+                    invalidate_index()
+                    queries.clear()
+                    if history is not None:
+                        history.forget_regions()
+                    if failed or not getattr(groomer, 'tracks_changes', False):
+                        report.untracked = True
+                if history is not None:
+                    history.record(groomer, fingerprint, report.findings[findings:], failed)
+            if profile is not None:
+                profile.stop(groomer.__name__, started, report)
+        i += len(run)
+    if concurrent:
+        run_checks(root, groomer_list[checks:], report, log, report_errors, history, queries)
+    report.groomer = None
+    return root
+
+
+def call_groomer(groomer, root, report, nodes=None):
+    """Run groomer and return (root, error), error being None or the
+    exception it raised and its formatted traceback.
+    """
+    try:
+        if nodes is None:
+            return groomer(root, report), None
+        return groomer(root, report, nodes), None
+    except Exception as ee:
+        return root, (ee, traceback.format_exc())
+
+
+def report_failure(groomer, error, report, log, report_errors):
+    ee, trace = error
+    sys.stderr.write(trace)
+    print >>sys.stderr, '** error in '+groomer.__name__+': '+str(ee)+'\n'
+    if report_errors:
+        report.error('error in '+groomer.__name__+': '+str(ee))
+    log.write('** error in '+groomer.__name__+': '+str(ee)+'\n')
+    report.failed.append(groomer.__name__)
+
+
+# threads for the read-only checks at the end of a run; 1 runs them in turn
+check_threads = min(4, multiprocessing.cpu_count())
+_check_pool = (None, None)
+_check_pool_lock = threading.Lock()
 
-    if not args.error_check:
-        for char_stream_groomer in char_stream_groomers:
-            char_stream = char_stream_groomer(char_stream)
+
+def get_check_pool():
+    """Return this process's pool of check_threads threads."""
+    global _check_pool
+    with _check_pool_lock:
+        pid, pool = _check_pool
+        if pool is None or pid != os.getpid():
+            pool = multiprocessing.pool.ThreadPool(check_threads)
+            _check_pool = (os.getpid(), pool)
+        return pool
+
+
+def run_checks(root, checks, report, log, report_errors, history, queries):
+    """Run read_only groomers at the same time on the check pool.
+
+    None of them changes root, so they share its QueryCache, ArticleIndex
+    and one walk for their dispatched nodes.  Each reports to a Report of
+    its own, and their findings and failures are added to report in the
+    order of checks, as if they had run in turn.
+    """
+    dispatched = [groomer for groomer in checks if hasattr(groomer, 'tags')]
+    dispatched_nodes = iter(collect_nodes(root, dispatched))
+    index = article_index(root)
+    jobs = []
+    for groomer in checks:
+        nodes = next(dispatched_nodes) if hasattr(groomer, 'tags') else None
+        check_report = Report()
+        check_report.groomer = groomer.__name__
+        fingerprint = history.fingerprint(root, groomer) if history is not None else None
+        reused = fingerprint is not None and history.reuse(groomer, fingerprint, check_report)
+        jobs.append((groomer, nodes, check_report, fingerprint, reused))
+
+    def run_check(job):
+        groomer, nodes, check_report, fingerprint, reused = job
+        if reused:
+            return None
+        _local.queries, _local.index = queries, index
+        try:
+            return call_groomer(groomer, root, check_report, nodes)[1]
+        finally:
+            _local.queries = _local.index = None
+
+    errors = get_check_pool().map(run_check, jobs)
+    for (groomer, nodes, check_report, fingerprint, reused), error in zip(jobs, errors):
+        if error is not None:
+            report_failure(groomer, error, check_report, log, report_errors)
+        report.merge(check_report)
+        if history is not None and not reused:
+            history.record(groomer, fingerprint, check_report.findings, error is not None)
+
+
+def get_parser():
+    """Return this thread's parser, made once and reused for every article."""
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = etree.XMLParser(recover=True)
+    return parser
+
+
+def parse_front(data):
+    """Parse an article from UTF-8 bytes, stopping at the end of its front.
+
+    Returns (root, read): root holds the front and nothing after it, or the
+    whole article if it has no front, and read is how many bytes of data
+    the parser took in.
+    """
+    if isinstance(data, mmap.mmap):
+        f = data
+        f.seek(0)
+    else:
+        f = StringIO.StringIO(data)
+    context = etree.iterparse(f, tag='front', recover=True)
+    for event, front in context:
+        break
+    else:
+        return context.root, f.tell()
+    del context
+    # the parser reads ahead a chunk at a time; drop what it built past front
+    for node in list(front.itersiblings()):
+        front.getparent().remove(node)
+    return front.getroottree().getroot(), f.tell()
+
+
+def groom_article(data, error_check, log, source=None, profile=None, history=None):
+    """Groom an article given as UTF-8 bytes and return (root, report).
+
+    data may also be a buffer over the bytes, such as an mmap.  Runs the
+    char stream groomers and groomers, or only the validators if error_check
+    is set.  When the char stream groomers have nothing to do, the article
+    is parsed without being decoded, from the file named by source if given.
+    Error checks whose validators are all front_matter stop at </front>.
+    Per-groomer failures are logged and do not stop the run; parse failures
+    are logged and raised.  Stages are recorded in profile, if given.  With
+    a GroomHistory, the run is incremental against the last one for the DOI.
+    """
+    report = Report()
+    parser = get_parser()
+
+    if profile is not None:
+        started = profile.start(report)
+    front_only = error_check and all(getattr(fn, 'front_matter', False) for fn in validators)
+    if front_only:
+        # checked as far as it is parsed, below
+        xml = None
+    elif error_check or not needs_char_scan(data, char_stream_groomers):
+        check_utf8(data)
+        xml = None
+    else:
+        char_stream = data[:].decode('utf-8')
+        char_stream = scan_char_stream(char_stream, report, char_stream_groomers)
+        report.groomer = None
+        # deletions move everything after them in the bytes parsed
+        if report.changes:
+            report.untracked = True
+        xml = char_stream.encode('utf-8')
+        del char_stream
+    if profile is not None:
+        profile.stop('scan_char_stream', started, report)
+        started = profile.start(report)
 
     try:
-        parser = etree.XMLParser(recover=True)
-        root = etree.fromstring(char_stream.encode('utf-8'), parser)
+        if front_only:
+            root, read = parse_front(data)
+            # the parser may have stopped reading partway through a character
+            check_utf8(data[:read], final=False)
+        elif xml is not None:
+            root = etree.fromstring(xml, parser)
+        elif source is not None:
+            root = etree.parse(source, parser).getroot()
+        elif isinstance(data, mmap.mmap):
+            # such as stdin redirected from a file
+            data.seek(0)
+            root = etree.parse(data, parser).getroot()
+        else:
+            root = etree.fromstring(data, parser)
     except Exception as ee:
         log.write('** error parsing: '+str(ee)+'\n')
-        log.close()
         raise
-    try: log.write(get_doi(root)+'\n')
-    except: log.write('** error getting doi\n')
+    del xml
+    if profile is not None:
+        profile.stop('parse', started, report)
+    try:
+        doi = get_doi(root)
+        log.write(doi+'\n')
+    except:
+        doi = None
+        log.write('** error getting doi\n')
+
+    article_history = None
+    if history is not None and doi:
+        article_history = history.load(doi, error_check)
+    try:
+        if error_check:
+            root = run_groomers(root, validators, report, log, report_errors=True, profile=profile,
+                                history=article_history)
+        else:
+            root = run_groomers(root, groomers, report, log, profile=profile, history=article_history)
+    finally:
+        invalidate_index()
+    if report.skipped:
+        log.write('skipped groomers that do not apply: %s\n' % ', '.join(report.skipped))
+    if article_history is not None:
+        article_history.save()
+        log.write('reused the findings of %d groomers\n' % article_history.reused)
+    return root, report
+
+
+def map_file(f):
+    """Map an open file read-only, or read it if it cannot be mapped."""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        # empty files and pipes
+        return f.read()
 
-    if args.error_check:
-        for groomer in validators:
-            try:
-                root = groomer(root)
-            except Exception as ee:
-                traceback.print_exc()
-                print >>sys.stderr, '** error in '+groomer.__name__+': '+str(ee)+'\n'
-                output += 'error: error in '+groomer.__name__+': '+str(ee)+'\n'
-                log.write('** error in '+groomer.__name__+': '+str(ee)+'\n')
 
+def write_article(root, f):
+    """Write the groomed article to the open file f, with an XML declaration
+    and the input's DOCTYPE, serializing it into f in chunks instead of as
+    one string.
+    """
+    tree = root.getroottree()
+    dtd = tree.docinfo.internalDTD
+    if (root.getprevious() is not None or root.getnext() is not None
+            or dtd is not None and (any(dtd.iterelements()) or any(dtd.iterentities()))):
+        # xmlfile writes neither nodes around the root nor an internal
+        # subset; ElementTree.write streams into f as well, just in one call
+        tree.write(f, xml_declaration=True, encoding='UTF-8')
+        return
+    with etree.xmlfile(f, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        if tree.docinfo.doctype:
+            xf.write_doctype(tree.docinfo.doctype)
+        xf.write(root)
+
+
+_element_patterns = {}
+_xmlns = re.compile(r'\sxmlns(?::([^\s=]+))?\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_newline = re.compile(r'\n')
+
+
+def element_pattern(qname):
+    """Match the start and end tags of elements named qname, group 1 being
+    '/' in end tags, and the comments, CDATA sections and processing
+    instructions that may hide such tags (group 1 None).
+    """
+    pattern = _element_patterns.get(qname)
+    if pattern is None:
+        pattern = _element_patterns[qname] = re.compile(
+            r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>'
+            r'|<(/?)%s(?=[\s/>])(?:[^>"\']|"[^"]*"|\'[^\']*\')*>' % re.escape(qname), re.S)
+    return pattern
+
+
+def line_offsets(data, lines):
+    """Return the offsets in data of the starts of lines 1 to lines + 1,
+    counted as libxml2 does: after each newline, but not after a bare
+    carriage return.
+    """
+    offsets = [None, 0]
+    pos = 0
+    while len(offsets) <= lines + 1:
+        match = _newline.search(data, pos)
+        if match is None:
+            offsets.extend([len(data)] * (lines + 2 - len(offsets)))
+            break
+        pos = match.end()
+        offsets.append(pos)
+    return offsets
+
+
+def source_range(data, offsets, node):
+    """Return (start, end, start tag) for node's bytes in data, the input it
+    was parsed from, or None unless they can be told for sure.
+
+    libxml2 records the line on which an element's start tag ends; that
+    line must hold the end of exactly one start tag of the same name.  Only
+    the tag at the last '<' before the line can reach into it, since '<'
+    cannot appear inside a tag.
+    """
+    line = node.sourceline
+    # line numbers saturate at 65535 in libxml2
+    if line is None or line >= 65535:
+        return None
+    qname = node.tag.split('}')[-1]
+    if node.prefix:
+        qname = node.prefix + ':' + qname
+    pattern = element_pattern(qname)
+    first, last = offsets[line], offsets[line + 1]
+    starts = []
+    pos = data.rfind('<', 0, first)
+    if pos < 0:
+        pos = data.find('<' + qname, 0, last)
+    while pos >= 0:
+        match = pattern.match(data, pos)
+        if match is not None and first < match.end() <= last:
+            starts.append(match)
+        pos = data.find('<' + qname, pos + 1, last)
+    if len(starts) != 1:
+        return None
+    start = starts[0]
+    if start.group(0).endswith('/>'):
+        return start.start(), start.end(), start.group(0)
+    depth = 1
+    for match in pattern.finditer(data, start.end()):
+        if match.group(1) is None:
+            continue
+        elif match.group(1):
+            depth -= 1
+            if not depth:
+                return start.start(), match.end(), start.group(0)
+        elif not match.group(0).endswith('/>'):
+            depth += 1
+    return None
+
+
+def serialize_in_place(node, start_tag):
+    """Serialize node as UTF-8 for splicing over its source, whose start tag
+    is start_tag, leaving out the namespace declarations lxml copies in from
+    its ancestors.
+    """
+    xml = etree.tostring(node, encoding='UTF-8', with_tail=False)
+    end = xml.index('>')
+    declared = set(match.group(1) for match in _xmlns.finditer(start_tag))
+    inherited = node.getparent().nsmap
+
+    def declaration(match):
+        prefix = match.group(1)
+        if prefix not in declared and inherited.get(prefix) == match.group(2):
+            return ''
+        return match.group(0)
+    return _xmlns.sub(declaration, xml[:end]) + xml[end:]
+
+
+def splice_article(root, report, data, f):
+    """Write the groomed article to f as the bytes data it was parsed from,
+    serializing again only the elements groomers touched.
+
+    Returns False, having written nothing, if that cannot be done safely:
+    the tree may have changed in untracked ways (see tracks_changes), the
+    root itself changed, data is not UTF-8 or a touched element cannot be
+    found in it.  An element is found by its tag on its source line, so
+    another element of that tag on the line, such as one renamed to it,
+    makes it ambiguous.
+    """
+    if report.untracked or root.getroottree().docinfo.encoding.upper() not in ('UTF-8', 'UTF8'):
+        return False
+
+    anchors = {}
+    for node in report.touched:
+        anchor = None
+        top = node
+        while True:
+            if anchor is None and isinstance(top.tag, basestring) and top.sourceline is not None:
+                anchor = top
+            if top.getparent() is None:
+                break
+            top = top.getparent()
+        # removed since; whoever removed it touched its parent
+        if top is not root:
+            continue
+        if anchor is None or anchor is root:
+            return False
+        anchors[anchor] = None
+    anchors = [anchor for anchor in anchors
+               if not any(parent in anchors for parent in anchor.iterancestors())]
+    if not anchors:
+        f.write(data[:])
+        return True
+
+    lines = collections.Counter((node.tag, node.sourceline)
+                                for node in root.iter(*set(anchor.tag for anchor in anchors)))
+    if any(lines[anchor.tag, anchor.sourceline] > 1 for anchor in anchors):
+        return False
+    offsets = line_offsets(data, max(anchor.sourceline for anchor in anchors))
+    ranges = []
+    for anchor in anchors:
+        found = source_range(data, offsets, anchor)
+        if found is None:
+            return False
+        start, end, start_tag = found
+        ranges.append((start, end, serialize_in_place(anchor, start_tag)))
+    ranges.sort()
+    if any(ranges[i][1] > ranges[i + 1][0] for i in range(len(ranges) - 1)):
+        return False
+    pos = 0
+    for start, end, xml in ranges:
+        f.write(data[pos:start])
+        f.write(xml)
+        pos = end
+    f.write(data[pos:])
+    return True
+
+
+def copy_article(path, afterxml):
+    """Copy the article at path to afterxml, '-' being stdout."""
+    if afterxml == '-':
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, sys.stdout)
+        sys.stdout.flush()
     else:
-        for groomer in groomers:
+        shutil.copyfile(path, afterxml)
+
+
+def groomer_fingerprint():
+    """Hash the names of the registered groomers and the source defining them.
+
+    Changes whenever a groomer is added, removed, reordered or edited, or
+    any helper in its module changes.
+    """
+    h = hashlib.sha1()
+    modules = set()
+    for registry in [groomers, validators, char_stream_groomers]:
+        for fn in registry:
+            h.update(fn.__name__ + '\n')
+            modules.add(fn.__module__)
+        h.update('\n')
+    for name in sorted(modules):
+        path = getattr(sys.modules.get(name), '__file__', None)
+        if path:
+            path = re.sub(r'\.py[co]$', '.py', path)
             try:
-                root = groomer(root)
-            except Exception as ee:
-                traceback.print_exc()
-                print >>sys.stderr, '** error in '+groomer.__name__+': '+str(ee)+'\n'
-                log.write('** error in '+groomer.__name__+': '+str(ee)+'\n')
-
-    if not dry_run and not args.error_check:
-        etree.ElementTree(root).write(args.afterxml, xml_declaration=True, encoding='UTF-8')
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+            except IOError:
+                h.update(name)
+    return h.hexdigest()
+
+
+def write_atomically(path, fill):
+    """Write a file through fill(f), so that readers see all of it or none."""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            fill(f)
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+
+def result_mode(error_check, afterxml, splice=False):
+    if error_check:
+        return 'error-check'
+    if afterxml:
+        return 'splice' if splice else 'groom'
+    return 'dry-run'
+
+
+class ResultCache(object):
+    """Grooming results on disk, keyed by the input bytes, the mode, the
+    groomer_fingerprint(), the vocabulary and the article's EM pubdate.
+
+    An entry is the report plus, in article_modes, the groomed article, and
+    is used for max_age seconds.  Past max_bytes the least recently used
+    entries are evicted; each process tracks the size on its own.
+    """
+
+    max_age = 24 * 3600
+    article_modes = ('groom', 'splice')
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = groomer_fingerprint()
+        self.size = None
+
+    def key(self, data, mode):
+        """Hash data and what else decides its result.  Raises if the
+        article's pubdate cannot be looked up.
+        """
+        root, read = parse_front(data)
+        pubdate = pubdate_provider.lookup(get_doi(root))
+        h = hashlib.sha1(self.fingerprint + vocabulary.digest + mode + '\n' + pubdate + '\n')
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def fresh(self, key, mode):
+        try:
+            if time.time() - os.path.getmtime(self.path(key, '.report')) > self.max_age:
+                return False
+        except OSError:
+            return False
+        return mode not in self.article_modes or os.path.exists(self.path(key, '.xml'))
+
+    def fetch(self, key, mode, afterxml):
+        """Return the cached report, or None; copies the article to afterxml."""
+        if not self.fresh(key, mode):
+            return None
+        try:
+            if mode in self.article_modes:
+                copy_article(self.path(key, '.xml'), afterxml)
+            with open(self.path(key, '.report'), 'rb') as f:
+                output = f.read().decode('utf-8')
+            # atime marks use; mtime stays the time the entry was written
+            now = time.time()
+            for ext in ['.report', '.xml']:
+                if os.path.exists(self.path(key, ext)):
+                    os.utime(self.path(key, ext), (now, os.path.getmtime(self.path(key, ext))))
+        except (IOError, OSError):
+            return None
+        return output
+
+    def store(self, key, mode, output, afterxml, write=None):
+        """Add an entry, the article being read back from afterxml, or written
+        again through write(f) if it went to stdout.
+        """
+        try:
+            if mode in self.article_modes and afterxml == '-':
+                self.write(key, '.xml', write)
+            elif mode in self.article_modes:
+                with open(afterxml, 'rb') as article:
+                    self.write(key, '.xml', lambda f: shutil.copyfileobj(article, f))
+            # the report goes last, so a listed entry is always complete
+            self.write(key, '.report', lambda f: f.write(output.encode('utf-8')))
+        except (IOError, OSError) as ee:
+            print >>sys.stderr, '** error caching result: '+str(ee)
+            return
+        self.evict()
+
+    def write(self, key, ext, fill):
+        write_atomically(self.path(key, ext), fill)
+        if self.size is not None:
+            self.size += os.path.getsize(self.path(key, ext))
+
+    def entries(self):
+        """Return (last used, size, key) for every entry."""
+        entries = {}
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext not in ('.report', '.xml'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            used, size = entries.get(key, (0, 0))
+            entries[key] = (max(used, st.st_atime), size + st.st_size)
+        return [(used, size, key) for key, (used, size) in entries.items()]
+
+    def evict(self):
+        if self.size is None:
+            self.size = sum(size for used, size, key in self.entries())
+        if self.size <= self.max_bytes:
+            return
+        entries = sorted(self.entries())
+        self.size = sum(size for used, size, key in entries)
+        for used, size, key in entries:
+            if self.size <= self.max_bytes:
+                break
+            for ext in ['.report', '.xml']:
+                try:
+                    os.unlink(self.path(key, ext))
+                except OSError:
+                    pass
+            self.size -= size
+
+
+class GroomHistory(object):
+    """The last run of every article groomed incrementally, one file per DOI.
+
+    Groomers and validators are tracked separately.  Runs by a different
+    version of the groomers (see groomer_fingerprint) or with a different
+    vocabulary are ignored.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.version = groomer_fingerprint()
+
+    def load(self, doi, error_check):
+        name = hashlib.sha1(doi).hexdigest() + ('.validators' if error_check else '.groomers')
+        return ArticleHistory(os.path.join(self.directory, name), self.version + vocabulary.digest)
+
+
+class ArticleHistory(object):
+    """Region fingerprints and findings of groomers' last run on an article.
+
+    A groomer declaring its regions (see reads) is skipped, and its last
+    findings reported again, when their fingerprint is unchanged and it is
+    read_only or made no corrections last time.  Fingerprints are taken
+    just before each groomer runs; run_groomers calls forget_regions when a
+    groomer may have changed the tree.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.previous = {}
+        self.current = {}
+        self.digests = {}
+        self.reused = 0
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['version'] == version:
+                self.previous = saved['groomers']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def fingerprint(self, root, groomer):
+        """Hash the regions groomer reads, or None if it declares none."""
+        regions = getattr(groomer, 'regions', None)
+        if regions is None:
+            return None
+        h = hashlib.sha1()
+        for region in regions:
+            digest = self.digests.get(region)
+            if digest is None:
+                region_hash = hashlib.sha1()
+                tree = root.getroottree()
+                for node in xpath(root, REGIONS[region]):
+                    if isinstance(node, etree._Element):
+                        region_hash.update(tree.getpath(node))
+                        region_hash.update(etree.tostring(node, with_tail=False))
+                    else:
+                        region_hash.update(node.encode('utf-8'))
+                    region_hash.update('\0')
+                digest = self.digests[region] = region_hash.hexdigest()
+            h.update(region + digest)
+        return h.hexdigest()
+
+    def reuse(self, groomer, fingerprint, report):
+        """Report groomer's last findings again if it need not run."""
+        last = self.previous.get(groomer.__name__)
+        if (not last or last['fingerprint'] != fingerprint
+            or (last['corrected'] and not getattr(groomer, 'read_only', False))):
+            return False
+        for severity, message in last['findings']:
+            report.add(severity, message)
+        self.current[groomer.__name__] = last
+        self.reused += 1
+        return True
+
+    def forget_regions(self):
+        self.digests.clear()
+
+    def record(self, groomer, fingerprint, findings, failed):
+        corrected = any(finding.severity == 'correction' for finding in findings)
+        if fingerprint is not None and not failed:
+            self.current[groomer.__name__] = {
+                'fingerprint': fingerprint,
+                'findings': [[finding.severity, finding.message] for finding in findings],
+                'corrected': corrected}
+
+    def save(self):
+        content = json.dumps({'version': self.version, 'groomers': self.current})
+        try:
+            write_atomically(self.path, lambda f: f.write(content))
+        except (IOError, OSError) as ee:
+            print >>sys.stderr, '** error saving groomer history: '+str(ee)
+
+
+def groom_file(beforexml, afterxml, error_check, log, profile=None, cache=None, history=None,
+               splice=False):
+    """Groom a single article and return its report.
+
+    Writes the groomed article to afterxml unless afterxml is None (dry run)
+    or error_check is set.  A beforexml of '-' reads the article from stdin
+    and an afterxml of '-' writes it to stdout.  With splice, the article is
+    written as the input with only the changed elements rewritten, where
+    splice_article can do that.  With a ResultCache, a cached result is used
+    instead of grooming, and a new result is cached unless a groomer failed.
+    With a GroomHistory the groomers run incrementally (see ArticleHistory).
+    Read and parse failures are logged and raised.
+    """
+    log.write('-'*50 + '\n'+time.strftime("%Y-%m-%d %H:%M:%S   "))
+    mode = result_mode(error_check, afterxml, splice)
+
+    if beforexml == '-':
+        data = map_file(sys.stdin)
+        source = None
     else:
-        output = output.replace('correction:', 'suggested correction:')
+        try:
+            f = open(beforexml, 'rb')
+        except IOError, e:
+            log.write(str(e)+'\n')
+            raise
+        try:
+            data = map_file(f)
+        finally:
+            f.close()
+        source = beforexml
+    try:
+        key = None
+        if cache is not None:
+            try:
+                key = cache.key(data, mode)
+            except Exception:
+                pass    # left for the pubdate groomers to report
+        if key is not None:
+            output = cache.fetch(key, mode, afterxml)
+            if output is not None:
+                log.write('cached result '+key+'\n')
+                log.write(output.encode('ascii','ignore'))
+                return output
+        root, report = groom_article(data, error_check, log, source, profile, history)
+
+        def write(f):
+            if not (splice and splice_article(root, report, data, f)):
+                write_article(root, f)
+        if afterxml == '-' and not error_check:
+            write(sys.stdout)
+            sys.stdout.flush()
+        elif afterxml and not error_check:
+            with open(afterxml, 'wb') as f:
+                write(f)
+        output = report.render(dry_run=not afterxml or error_check)
+        if key is not None and not report.failed:
+            cache.store(key, mode, output, afterxml, write)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
 
     log.write(output.encode('ascii','ignore'))
+    return output
+
+
+def batch_articles(sources, outdir=None, manifest=None):
+    """List the (beforexml, afterxml) pairs of a batch run.
+
+    sources may name article files, directories (every *.xml inside) or glob
+    patterns; their output goes to outdir under the same file name, or
+    nowhere (dry run) if outdir is None.  manifest is a file listing one
+    tab-separated "before.xml after.xml" pair per line, after.xml optional.
+    """
+    articles = []
+    for source in sources or []:
+        if os.path.isdir(source):
+            paths = sorted(glob.glob(os.path.join(source, '*.xml')))
+        else:
+            paths = sorted(glob.glob(source)) or [source]
+        for path in paths:
+            after = os.path.join(outdir, os.path.basename(path)) if outdir else None
+            articles.append((path, after))
+    if manifest:
+        with open(manifest) as f:
+            for line in f:
+                fields = [field.strip() for field in line.split('\t')]
+                if not fields[0] or fields[0].startswith('#'):
+                    continue
+                after = fields[1] if len(fields) > 1 and fields[1] else None
+                articles.append((fields[0], after))
+    return articles
+
+
+def read_doi(path):
+    """Return the DOI of the article at path, parsing no further than it."""
+    try:
+        for event, elem in etree.iterparse(path, tag='article-id', recover=True):
+            if elem.get('pub-id-type') == 'doi':
+                return elem.text
+    except Exception:
+        pass
+    return None
+
+
+def prefetch_pubdates(paths):
+    """Resolve the pubdates of a whole batch with one lookup_many call.
+
+    Pool workers are forked afterwards and inherit the filled memo.  Lookup
+    failures are left for the pubdate groomers to report per article.
+    """
+    dois = set(filter(None, [read_doi(path) for path in paths]))
+    try:
+        pubdate_provider.lookup_many(dois)
+    except Exception as ee:
+        print >>sys.stderr, '** error prefetching pubdates: '+str(ee)
+
+
+def groom_job(job):
+    """Groom one batch article, buffering its log lines.
+
+    Runs in pool workers, so everything an article produces, including its
+    XPath evaluation counts and profile (if profiling), comes back in one
+    piece and is written by the parent in batch order.  Changes to the
+    vocabulary file are picked up between articles.
+    """
+    beforexml, afterxml, error_check, profiling, cache, history, splice = job
+    refresh_vocabulary()
+    log = StringIO.StringIO()
+    profile = Profile() if profiling else None
+    xpath.counts.clear()
+    xpath.hits.clear()
+    try:
+        output = groom_file(beforexml, afterxml, error_check, log, profile, cache, history, splice)
+    except Exception as ee:
+        output = 'error: could not groom %s: %s\n' % (beforexml, ee)
+    return (beforexml, output, log.getvalue(), collections.Counter(xpath.counts),
+            collections.Counter(xpath.hits), profile)
+
+
+def print_xpath_counts(counts, hits):
+    print >>sys.stderr, 'xpath evaluations and query cache hits:'
+    for path in sorted(set(counts) | set(hits), key=lambda path: (-counts[path], path)):
+        print >>sys.stderr, '%8d %8d  %s' % (counts[path], hits[path], path)
+    print >>sys.stderr, '%8d %8d  total' % (sum(counts.values()), sum(hits.values()))
+
+
+def write_profile(profile, path):
+    if path:
+        with open(path, 'w') as f:
+            f.write(profile.to_json())
+    else:
+        sys.stderr.write(profile.render())
+
+
+def main():
+    global pubdate_provider, check_threads
+    parser = argparse.ArgumentParser("xmlgroomer.py before.xml after.xml ('-' for stdin/stdout)\n"
+                                     "dry run: xmlgroomer.py before.xml\n"
+                                     "batch: xmlgroomer.py -b DIR|GLOB [-o OUTDIR] | -m MANIFEST")
+    parser.add_argument("-e", "--error-check", action='store_true')
+    parser.add_argument("-b", "--batch", action='append', metavar='SOURCE',
+                        help="article file, directory or glob to groom in one run")
+    parser.add_argument("-o", "--outdir",
+                        help="output directory for --batch articles (dry run if omitted)")
+    parser.add_argument("-m", "--manifest",
+                        help="file of tab-separated before.xml/after.xml pairs")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes for batch runs")
+    parser.add_argument("--max-tasks-per-child", type=int, default=200, metavar='N',
+                        help="recycle each worker after grooming N articles")
+    parser.add_argument("--check-threads", type=int, default=check_threads, metavar='N',
+                        help="threads for the read-only checks that end a run (1 runs them in turn)")
+    parser.add_argument("--pubdates", metavar='FILE',
+                        help="read EM pubdates from tab-separated doi/date lines instead of getPubdate.php")
+    parser.add_argument("--vocabulary", metavar='FILE',
+                        help="read article types, journal titles and NLM TAs from FILE instead of vocabulary.json")
+    parser.add_argument("--xpath-stats", action='store_true',
+                        help="print how often each XPath was evaluated or answered from cache to stderr")
+    parser.add_argument("--cache-dir", default=CACHE_PATH,
+                        help="directory of cached results, keyed by input, mode and groomer version")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar='MB',
+                        help="evict least recently used results beyond this size")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="groom every article afresh and cache nothing")
+    parser.add_argument("--incremental", action='store_true',
+                        help="rerun only groomers whose regions changed since the article's last run")
+    parser.add_argument("--history-dir", default=HISTORY_PATH,
+                        help="directory of per-DOI groomer history for --incremental")
+    parser.add_argument("--splice", action='store_true',
+                        help="copy the input, rewriting only the elements groomers changed, where that is safe")
+    parser.add_argument("--profile", action='store_true',
+                        help="print each groomer's time, findings and XPath evaluations to stderr")
+    parser.add_argument("--profile-json", metavar='FILE',
+                        help="write the --profile figures to FILE as JSON instead")
+    parser.add_argument("beforexml", nargs='?')
+    parser.add_argument("afterxml", nargs='?')
+    args = parser.parse_args()
+
+    batch = bool(args.batch or args.manifest)
+    if batch == bool(args.beforexml):
+        parser.error("give either before.xml or --batch/--manifest")
+
+    if args.pubdates:
+        pubdate_provider = FilePubdateProvider(args.pubdates)
+    check_threads = args.check_threads
+    if args.vocabulary:
+        reload_vocabulary(args.vocabulary)
+    profiling = args.profile or bool(args.profile_json)
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = ResultCache(args.cache_dir, args.cache_size << 20)
+        except OSError as ee:
+            print >>sys.stderr, '** not caching results: '+str(ee)
+    history = None
+    if args.incremental:
+        try:
+            history = GroomHistory(args.history_dir)
+        except OSError as ee:
+            print >>sys.stderr, '** not grooming incrementally: '+str(ee)
+    log = open(LOG_PATH, 'a')
+
+    if not batch:
+        profile = Profile() if profiling else None
+        try:
+            output = groom_file(args.beforexml, args.afterxml, args.error_check, log, profile, cache,
+                                history, args.splice)
+        except IOError, e:
+            sys.exit(e)
+        finally:
+            log.close()
+        # keep stdout for the article when it goes there
+        out = sys.stderr if args.afterxml == '-' and not args.error_check else sys.stdout
+        out.write(output.encode('utf-8') + '\n')
+        if args.xpath_stats:
+            print_xpath_counts(xpath.counts, xpath.hits)
+        if profiling:
+            write_profile(profile, args.profile_json)
+        return
+
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    articles = batch_articles(args.batch, args.outdir, args.manifest)
+    prefetch_pubdates([beforexml for beforexml, afterxml in articles])
+    jobs = [(beforexml, afterxml, args.error_check, profiling, cache, history, args.splice)
+            for beforexml, afterxml in articles]
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, maxtasksperchild=args.max_tasks_per_child)
+        results = pool.imap(groom_job, jobs)
+    else:
+        results = itertools.imap(groom_job, jobs)
+    xpath_counts = collections.Counter()
+    xpath_hits = collections.Counter()
+    profile = Profile()
+    for beforexml, output, log_text, counts, hits, article_profile in results:
+        xpath_counts.update(counts)
+        xpath_hits.update(hits)
+        if article_profile:
+            profile.merge(article_profile)
+        log.write(log_text)
+        print '==> %s <==' % beforexml
+        print output.encode('utf-8')
+    if pool:
+        pool.close()
+        pool.join()
     log.close()
-    print output.encode('utf-8')
+    if args.xpath_stats:
+        print_xpath_counts(xpath_counts, xpath_hits)
+    if profiling:
+        write_profile(profile, args.profile_json)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# usage: xmlgroomerbench.py [--scales 1,10,100] [--repeat 3] [--json FILE]
+#
+# Generates PLOS articles at increasing sizes, times every groomer,
+# validator and the char stream scan on each, and reports how their times
+# grow with the article.  A groomer whose time grows faster than
+# size**max_slope (1.5 by default) is flagged and the exit status is 1, so
+# a groomer gone quadratic shows up before it reaches production.
+
+import sys
+import math
+import time
+import copy
+import json
+import argparse
+import StringIO
+import lxml.etree as etree
+import xmlgroomer
+
+
+# element counts of a typical research article, multiplied by the scale
+COUNTS = {
+    'authors': 8,
+    'affiliations': 4,
+    'sections': 6,
+    'paragraphs': 30,
+    'references': 40,
+    'links': 10,
+    'figures': 6,
+    'supp_files': 4,
+    'formulas': 4,
+    'pua': 2,
+}
+
+DOI = '10.1371/journal.pone.0001234'
+PUBDATE = '2012-03-04'
+
+
+def make_article(authors=8, affiliations=4, sections=6, paragraphs=30, references=40,
+                 links=10, figures=6, supp_files=4, formulas=4, pua=2):
+    """Return a PLOS ONE research article as UTF-8 bytes.
+
+    Content is spread evenly through the body, and about one in four of the
+    authors, links, references and SI files carries something for the
+    groomers to fix, as real articles do.
+    """
+    sections = max(sections, 1)
+    out = []
+    w = out.append
+    w('<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<!DOCTYPE article PUBLIC "-//NLM//DTD Journal Publishing DTD v3.0 20080202//EN" '
+      '"http://dtd.nlm.nih.gov/publishing/3.0/journalpublishing3.dtd">\n'
+      '<article xmlns:xlink="http://www.w3.org/1999/xlink" '
+      'xmlns:mml="http://www.w3.org/1998/Math/MathML" article-type="research-article">\n'
+      '<front>\n<journal-meta>\n'
+      '<journal-id journal-id-type="nlm-ta">PLoS ONE</journal-id>\n'
+      '<journal-id journal-id-type="pmc">plosone</journal-id>\n'
+      '<journal-title-group><journal-title>PLoS ONE</journal-title></journal-title-group>\n'
+      '</journal-meta>\n<article-meta>\n'
+      '<article-id pub-id-type="doi">%s</article-id>\n'
+      '<article-categories><subj-group subj-group-type="heading"><subject>Research Article</subject></subj-group>\n'
+      '<subj-group subj-group-type="Discipline-v2"><subject>Biology</subject></subj-group></article-categories>\n'
+      '<title-group><article-title>Scaling of\tgroomers with  article size </article-title>'
+      '<alt-title alt-title-type="running-head">Groomer &lt;i&gt;scaling&lt;/i&gt;</alt-title></title-group>\n'
+      '<contrib-group>\n' % DOI)
+    for i in range(authors):
+        xref = '' if i % 4 == 3 else '<xref ref-type="aff" rid="aff%d">%d</xref>' % (i % max(affiliations, 1) + 1, i + 1)
+        w('<contrib contrib-type="author"><name><surname>Author%d</surname>'
+          '<given-names>Given</given-names></name>%s</contrib>\n' % (i, xref))
+    w('</contrib-group>\n')
+    for i in range(affiliations):
+        w('<aff id="aff%d"><addr-line>Department %d, University, City, Country</addr-line>%s</aff>\n'
+          % (i + 1, i, ',' if i % 4 == 3 else ''))
+    w('<aff id="edit1"><addr-line>University of Somewhere, City, Country</addr-line></aff>\n'
+      '<author-notes><corresp id="cor1">* E-mail: author0@example.org</corresp></author-notes>\n'
+      '<pub-date pub-type="epub"><day>4</day><month>3</month><year>2012</year></pub-date>\n'
+      '<pub-date pub-type="collection"><year>2012</year></pub-date>\n'
+      '<volume>7</volume><issue>3</issue><elocation-id>e1234</elocation-id>\n'
+      '<permissions><copyright-year>2012</copyright-year><license><license-p>This is an '
+      'open-access article distributed under the terms of the Creative Commons Attribution '
+      'License.</license-p></license></permissions>\n'
+      '<funding-group><funding-statement>The authors have no support or funding to report.'
+      '</funding-statement></funding-group>\n'
+      '</article-meta>\n</front>\n<body>\n')
+
+    def spread(count, section):
+        return range(section, count, sections)
+
+    for s in range(sections):
+        w('<sec id="s%d"><title>Section %d </title>\n' % (s + 1, s + 1))
+        for i in spread(paragraphs, s):
+            w('<p>Cells were treated with estradiol (10 nM) and lysed; protein levels were '
+              'measured in triplicate <xref ref-type="bibr" rid="B%d">[%d]</xref>.</p>\n'
+              % (i % max(references, 1) + 1, i % max(references, 1) + 1))
+        for i in spread(pua, s):
+            w(u'<p>Character \ue000 from the private use area.</p>\n'.encode('utf-8'))
+        for i in spread(links, s):
+            href = ['http://www.example.org/%d' % i, 'www.example.org/%d' % i,
+                    '10.1234/journal.%d' % i, 'http://www.plos.org/%d' % i][i % 4]
+            w('<p>Data are at <ext-link ext-link-type="uri" xlink:href="%s">%s</ext-link>.</p>\n'
+              % (href, href))
+        for i in spread(formulas, s):
+            w('<p><inline-formula><mml:math><mml:mrow><mml:msup><mml:mi>x</mml:mi><mml:mn>%d</mml:mn>'
+              '</mml:msup><mml:mo>+</mml:mo><mml:mi>y</mml:mi></mml:mrow></mml:math></inline-formula></p>\n'
+              '<disp-formula id="pone.0001234.e%03d"><graphic xlink:href="pone.0001234.e%03d.tif" '
+              'position="anchor"/></disp-formula>\n' % (i, i + 1, i + 1))
+        for i in spread(figures, s):
+            w('<fig id="pone-0001234-g%03d"><label>Figure %d</label><caption><title>Figure %d.</title>'
+              '<p>Legend.</p></caption><graphic xlink:href="pone.0001234.g%03d.tif"/></fig>\n'
+              % (i + 1, i + 1, i + 1, i + 1))
+        for i in spread(supp_files, s):
+            ext, mimetype = [('tif', 'image/tiff'), ('doc', 'application/msword'),
+                             ('xls', 'application/vnd.ms-excel'), ('pdf', 'application/pdf')][i % 4]
+            w('<supplementary-material id="pone.0001234.s%03d" xlink:href="pone.0001234.s%03d.%s" '
+              'mimetype="%s"><label>Figure S%d%s</label><caption><p>(%s)</p></caption>'
+              '</supplementary-material>\n'
+              % (i + 1, i + 1, ext, mimetype, i + 1, '.' if i % 4 == 3 else '', ext.upper()))
+        w('</sec>\n')
+    w('</body>\n<back>\n<ack><p>We thank our colleagues.</p></ack>\n<ref-list>\n')
+    for i in range(references):
+        label = '<bold>%d</bold>' % (i + 1) if i % 4 == 3 else str(i + 1)
+        w('<ref id="B%d"><label>%s</label><mixed-citation publication-type="journal">'
+          '<person-group person-group-type="author"><name><surname>Author%d</surname>'
+          '<given-names>A</given-names></name></person-group> (<year>2001</year>) '
+          '<article-title>Title</article-title>. <source>Journal</source> '
+          '<volume>%d</volume>: <fpage>%d</fpage>-<lpage>%d</lpage>.</mixed-citation></ref>\n'
+          % (i + 1, label, i, i % 50 + 1, i * 10 + 1, i * 10 + 9))
+    w('</ref-list>\n</back>\n</article>\n')
+    return ''.join(out)
+
+
+def scaled(scale):
+    return dict((name, count * scale) for name, count in COUNTS.items())
+
+
+class BenchPubdateProvider(xmlgroomer.PubdateProvider):
+    """Gives every DOI the same pubdate, so no time is spent asking EM."""
+
+    def fetch(self, dois):
+        return dict((doi, PUBDATE) for doi in dois)
+
+
+def best_time(fn, repeat, setup=lambda: None):
+    """Return the fastest of repeat runs of fn(setup()), in seconds."""
+    best = None
+    for i in range(repeat):
+        arg = setup()
+        start = time.time()
+        fn(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def time_article(data, repeat):
+    """Time each stage of grooming data and return {name: seconds}.
+
+    Each groomer and validator runs by itself on a fresh copy of the parsed
+    article, collecting its own nodes; failures count as whatever time they
+    took.  'pipeline' and 'error check' time the whole of groom_article.
+    """
+    times = {}
+    char_stream = data.decode('utf-8')
+    times['char stream scan'] = best_time(
+        lambda stream: xmlgroomer.scan_char_stream(stream, xmlgroomer.Report(),
+                                                   xmlgroomer.char_stream_groomers),
+        repeat, lambda: char_stream)
+    times['parse'] = best_time(
+        lambda xml: etree.fromstring(xml, etree.XMLParser(recover=True)), repeat, lambda: data)
+
+    root = etree.fromstring(data, etree.XMLParser(recover=True))
+
+    def run(groomer):
+        def call(tree):
+            try:
+                groomer(tree, xmlgroomer.Report())
+            except Exception:
+                pass
+        return call
+
+    for groomer in xmlgroomer.groomers + xmlgroomer.validators:
+        times[groomer.__name__] = best_time(run(groomer), repeat, lambda: copy.deepcopy(root))
+
+    for name, error_check in [('pipeline', False), ('error check', True)]:
+        times[name] = best_time(
+            lambda log: xmlgroomer.groom_article(data, error_check, log), repeat, StringIO.StringIO)
+    return times
+
+
+def slope(sizes, times, floor):
+    """Fit log(time) against log(size) by least squares and return the slope.
+
+    Times below floor are raised to it, so that timer noise on tiny
+    articles does not read as growth.
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, floor)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return (sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+            / sum((x - mx) ** 2 for x in xs))
+
+
+def run_benchmark(scales, repeat=3, floor=0.001, out=sys.stdout):
+    """Time every stage at each scale and return the results as a dict."""
+    provider = xmlgroomer.pubdate_provider
+    xmlgroomer.pubdate_provider = BenchPubdateProvider()
+    sizes = []
+    timings = []
+    try:
+        for scale in scales:
+            data = make_article(**scaled(scale))
+            sizes.append(len(data))
+            print >>out, 'timing %dx article (%d bytes)' % (scale, len(data))
+            timings.append(time_article(data, repeat))
+    finally:
+        xmlgroomer.pubdate_provider = provider
+    names = sorted(timings[0], key=lambda name: -timings[-1][name])
+    results = []
+    for name in names:
+        times = [t[name] for t in timings]
+        results.append({'name': name, 'times': times,
+                        'slope': slope(sizes, times, floor) if len(scales) > 1 else None})
+    return {'scales': scales, 'sizes': sizes, 'results': results}
+
+
+def print_results(bench, max_slope, out=sys.stdout):
+    print >>out, '%-45s' % 'stage' + ''.join('%11s' % ('%dx ms' % scale) for scale in bench['scales']) + '   slope'
+    for result in bench['results']:
+        line = '%-45s' % result['name'] + ''.join('%11.2f' % (t * 1000) for t in result['times'])
+        if result['slope'] is not None:
+            line += '%8.2f' % result['slope']
+            if result['slope'] > max_slope:
+                line += '  ** super-linear'
+        print >>out, line
+
+
+def main():
+    parser = argparse.ArgumentParser("xmlgroomerbench.py [--scales 1,10,100]")
+    parser.add_argument("--scales", default='1,10,100',
+                        help="comma-separated multiples of a typical article's element counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing; the fastest is kept")
+    parser.add_argument("--max-slope", type=float, default=1.5,
+                        help="flag stages whose log-log time/size slope is above this")
+    parser.add_argument("--floor", type=float, default=0.001,
+                        help="seconds below which times are treated as noise")
+    parser.add_argument("--json", metavar='FILE', help="also write the results as JSON to FILE")
+    parser.add_argument("--article", type=int, metavar='SCALE',
+                        help="write the generated article at SCALE to stdout and exit")
+    args = parser.parse_args()
+
+    if args.article:
+        sys.stdout.write(make_article(**scaled(args.article)))
+        return
+
+    bench = run_benchmark([int(scale) for scale in args.scales.split(',')],
+                          args.repeat, args.floor, sys.stderr)
+    print_results(bench, args.max_slope)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(bench, f, indent=2)
+    if any(result['slope'] > args.max_slope for result in bench['results']
+           if result['slope'] is not None):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# usage: xmlgroomerserver.py [--port 8089 | --socket /path/to/socket]
+#
+# Keeps the groomers, compiled XPaths and pubdate lookups warm in one
+# process and grooms articles on request:
+#
+#   POST /groom?mode=groom|dry-run|error-check   body: article XML
+#        -> {"xml": groomed article or null, "report": report text}
+#   GET  /health
+#        -> {"status": "ok", "workers": N, "queued": N}
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import threading
+import traceback
+import urlparse
+import Queue
+import StringIO
+import BaseHTTPServer
+import SocketServer
+import lxml.etree as etree
+import xmlgroomer
+
+
+MODES = {'groom': False, 'dry-run': False, 'error-check': True}
+
+
+class GroomServerMixIn:
+    """Handle requests on a fixed pool of worker threads.
+
+    Requests wait in a queue of at most `backlog` entries; when it is full,
+    or a request has waited longer than `request_timeout` seconds, the
+    client gets a 503 instead.  Once a worker takes a request it is not
+    timed out, apart from reading it; EM lookups give up after
+    PhpPubdateProvider.timeout seconds.  EM pubdates can change while the
+    server runs, so they are only remembered for `pubdate_ttl` seconds.
+    The vocabulary is reloaded whenever its file changes.
+    """
+
+    workers = 4
+    backlog = 16
+    request_timeout = 30
+    pubdate_ttl = 300
+    log = None
+
+    def start_workers(self):
+        self.pubdates_cleared = time.time()
+        self.requests = Queue.Queue(self.backlog)
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            self.reject(request, 'server busy')
+
+    def process_requests(self):
+        while True:
+            request, client_address, queued_at = self.requests.get()
+            if time.time() - queued_at > self.request_timeout:
+                self.reject(request, 'timed out waiting for a worker')
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def reject(self, request, reason):
+        try:
+            body = json.dumps({'error': reason})
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Content-Type: application/json\r\n'
+                            'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def expire_pubdates(self):
+        if time.time() - self.pubdates_cleared > self.pubdate_ttl:
+            # replaced, not cleared, since other workers may be reading it
+            xmlgroomer.pubdate_provider.memo = {}
+            self.pubdates_cleared = time.time()
+
+
+class HTTPServer(GroomServerMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+
+class UnixHTTPServer(GroomServerMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+class GroomHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    log_lock = threading.Lock()
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - - [%s] %s\n" % (self.address_string(),
+                                               self.log_date_time_string(), format % args))
+
+    def send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != '/health':
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, {'status': 'ok',
+                             'workers': self.server.workers,
+                             'queued': self.server.requests.qsize()})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/groom':
+            return self.send_json(404, {'error': 'not found'})
+        mode = urlparse.parse_qs(url.query).get('mode', ['groom'])[0]
+        if mode not in MODES:
+            return self.send_json(400, {'error': 'mode must be one of %s' % ', '.join(sorted(MODES))})
+        try:
+            data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        except (ValueError, socket.timeout) as ee:
+            return self.send_json(400, {'error': 'could not read article: %s' % ee})
+
+        self.server.expire_pubdates()
+        xmlgroomer.refresh_vocabulary()
+        log = StringIO.StringIO()
+        log.write('-'*50 + '\n'+time.strftime("%Y-%m-%d %H:%M:%S   "))
+        try:
+            root, report = xmlgroomer.groom_article(data, MODES[mode], log)
+        except Exception as ee:
+            traceback.print_exc()
+            return self.send_json(422, {'error': 'could not groom article: %s' % ee})
+        finally:
+            self.write_log(log.getvalue())
+
+        xml = None
+        if mode == 'groom':
+            xml = etree.tostring(etree.ElementTree(root), xml_declaration=True, encoding='UTF-8')
+        output = report.render(dry_run=mode != 'groom')
+        self.write_log(output.encode('ascii', 'ignore'))
+        self.send_json(200, {'xml': xml, 'report': output})
+
+    def write_log(self, text):
+        if self.server.log:
+            with self.log_lock:
+                self.server.log.write(text)
+                self.server.log.flush()
+
+
+def make_server(address, log=None, workers=4, backlog=16, request_timeout=30, pubdate_ttl=300):
+    """Create a groom server on a (host, port) pair or a Unix socket path."""
+    if isinstance(address, tuple):
+        server = HTTPServer(address, GroomHandler)
+    else:
+        server = UnixHTTPServer(address, GroomHandler)
+    server.workers = workers
+    server.backlog = backlog
+    server.request_timeout = request_timeout
+    server.pubdate_ttl = pubdate_ttl
+    server.log = log
+    server.start_workers()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser("xmlgroomerserver.py [--port PORT | --socket PATH]")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of HTTP on localhost")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--backlog", type=int, default=16,
+                        help="requests allowed to wait for a worker before answering 503")
+    parser.add_argument("--timeout", type=int, default=30,
+                        help="seconds a request may take to arrive or wait for a worker; "
+                             "grooming itself is not timed out")
+    parser.add_argument("--pubdate-ttl", type=int, default=300,
+                        help="seconds to remember EM pubdates")
+    parser.add_argument("--pubdates", metavar='FILE',
+                        help="read EM pubdates from tab-separated doi/date lines instead of getPubdate.php")
+    parser.add_argument("--vocabulary", metavar='FILE',
+                        help="read article types, journal titles and NLM TAs from FILE instead of vocabulary.json")
+    parser.add_argument("--log", default=xmlgroomer.LOG_PATH)
+    args = parser.parse_args()
+
+    if args.pubdates:
+        xmlgroomer.pubdate_provider = xmlgroomer.FilePubdateProvider(args.pubdates)
+    if args.vocabulary:
+        xmlgroomer.reload_vocabulary(args.vocabulary)
+    if args.socket:
+        try:
+            os.unlink(args.socket)
+        except OSError:
+            pass
+        address = args.socket
+    else:
+        address = (args.host, args.port)
+
+    server = make_server(address, open(args.log, 'a'), args.workers, args.backlog,
+                         args.timeout, args.pubdate_ttl)
+    print >>sys.stderr, 'xmlgroomer serving on %s' % (address,)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
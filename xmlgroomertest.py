@@ -3,24 +3,50 @@
 # usage: nosetests xmlgroomertest.py
 
 
+import os
+import re
+import json
+import shutil
+import httplib
+import tempfile
+import StringIO
+import threading
 import lxml.etree as etree
 import xmlgroomer as x
+import xmlgroomerserver
+import xmlgroomerbench
 from lxml import html
 from nose import tools
 
 
 def verify(before, after, groomer, *args):
     goal = normalize(after)
-    result = normalize(etree.tostring(groomer(etree.fromstring(before), *args)))
+    report = x.Report()
+    root = groomer(etree.fromstring(before), report, *args)
+    result = normalize(etree.tostring(root))
     if goal != result:
         print 'goal: %r' % goal
         print 'result: %r' % result
         assert False
+    if getattr(groomer, 'tracks_changes', False):
+        verify_splice(before, root, report)
+
+
+def verify_splice(before, root, report):
+    """Check that splicing the groomed root over before, where it can be
+    done, writes what a full serialization would.
+    """
+    if isinstance(before, unicode):
+        before = before.encode('utf-8')
+    f = StringIO.StringIO()
+    if x.splice_article(root, report, before, f):
+        tools.eq_(etree.tostring(etree.fromstring(f.getvalue()), method='c14n'),
+                  etree.tostring(root, method='c14n'))
 
 
 def verify_char_stream(before, after, groomer, *args):
     goal = normalize(after)
-    result = normalize(groomer(before), *args)
+    result = normalize(groomer(before, x.Report()), *args)
     if goal != result:
         print 'goal:\n', goal
         print 'result:\n', result
@@ -28,28 +54,208 @@ def verify_char_stream(before, after, groomer, *args):
 
 
 def check_char_stream(before, message, groomer):
-    x.output = ''
-    groomer(before)
-    if x.output.strip() != message.strip():
+    report = x.Report()
+    groomer(before, report)
+    if report.render().strip() != message.strip():
         print 'goal:   %r' % message
-        print 'result: %r' % x.output
+        print 'result: %r' % report.render()
         assert False
 
 
+def verify_with_pubdates(before, after, groomer, pubdates):
+    tmp = tempfile.mkdtemp()
+    provider = x.pubdate_provider
+    try:
+        with open(os.path.join(tmp, 'pubdates'), 'w') as f:
+            f.write(pubdates)
+        x.pubdate_provider = x.FilePubdateProvider(os.path.join(tmp, 'pubdates'))
+        verify(before, after, groomer)
+    finally:
+        x.pubdate_provider = provider
+        shutil.rmtree(tmp)
+
+
 def normalize(string):
     string = ''.join([line.strip() for line in string.split('\n')])
     return etree.tostring(etree.fromstring(string))
 
 
 def check(before, message, groomer):
-    x.output = ''
-    groomer(etree.fromstring(before))
-    if x.output.strip() != message.strip():
+    report = x.Report()
+    groomer(etree.fromstring(before), report)
+    if report.render().strip() != message.strip():
         print 'goal:   %r' % message
-        print 'result: %r' % x.output
+        print 'result: %r' % report.render()
         assert False
 
 
+def test_report():
+    report = x.Report()
+    report.groomer = 'fix_volume'
+    report.correction('changed volume from 1 to 2')
+    report.groomer = 'check_nlm_ta'
+    report.error('missing nlm-ta in metadata')
+    tools.eq_([(f.severity, f.groomer) for f in report.findings],
+              [('correction', 'fix_volume'), ('error', 'check_nlm_ta')])
+    tools.eq_(report.render(), 'correction: changed volume from 1 to 2\n'
+                               'error: missing nlm-ta in metadata\n')
+    tools.eq_(report.render(dry_run=True), 'suggested correction: changed volume from 1 to 2\n'
+                                           'error: missing nlm-ta in metadata\n')
+
+
+def test_profile():
+    root = etree.fromstring('<article><sec><title>Results </title></sec>'
+                            '<sec><title>Acknowledgements</title></sec></article>')
+    report = x.Report()
+    profile = x.Profile()
+    x.run_groomers(root, [x.fix_title, x.check_sec_ack_title, x.fix_headed_title],
+                   report, StringIO.StringIO(), profile=profile)
+    tools.eq_(profile.stats.keys(), ['collect_nodes', 'fix_title', 'check_sec_ack_title', 'fix_headed_title'])
+    tools.eq_([(s['findings'], s['mutated']) for s in profile.stats.values()],
+              [(0, 0), (1, 1), (1, 0), (0, 0)])
+    total = x.Profile()
+    total.merge(profile)
+    total.merge(profile)
+    tools.eq_(total.stats['fix_title']['calls'], 2)
+    assert 'check_sec_ack_title' in total.render()
+
+    # changes without a correction count too
+    @x.tracks_changes
+    def fix_quietly(root, report):
+        root.set('article-type', 'research-article')
+        report.touch(root)
+        return root
+    x.run_groomers(root, [fix_quietly], report, StringIO.StringIO(), profile=profile)
+    tools.eq_(profile.stats['fix_quietly']['mutated'], 1)
+
+def test_collect_nodes():
+    root = etree.fromstring('<article><sec sec-type="headed"><title>A:</title></sec>'
+                            '<sec><title>Acknowledgements</title><ext-link/></sec></article>')
+    headed, acks, links = x.collect_nodes(root, [x.fix_headed_title, x.check_sec_ack_title, x.fix_url])
+    tools.eq_([t.text for t in headed], ['A:'])
+    tools.eq_([t.text for t in acks], ['Acknowledgements'])
+    tools.eq_([l.tag for l in links], ['ext-link'])
+
+
+def test_run_checks():
+    article = ('<article><front><journal-meta><journal-id journal-id-type="nlm-ta">PLoS Bio'
+                            '</journal-id></journal-meta></front><body><sec><title>Acknowledgements</title>'
+                            '<p><named-content content-type="pullquote">q</named-content></p></sec>'
+                            '<sec><title>Results </title></sec></body></article>')
+    threads = []
+
+    @x.read_only
+    def check_thread(root, report):
+        threads.append(threading.current_thread())
+        raise ValueError('no thread')
+
+    checks = [x.fix_title, x.check_sec_ack_title, check_thread, x.check_nlm_ta, x.check_misplaced_pullquotes]
+    check_threads = x.check_threads
+    try:
+        for x.check_threads in (1, 4):
+            report = x.Report()
+            log = StringIO.StringIO()
+            x.run_groomers(etree.fromstring(article), checks, report, log, report_errors=True)
+            tools.eq_([f.groomer for f in report.findings],
+                      ['fix_title', 'check_sec_ack_title', 'check_thread', 'check_nlm_ta',
+                       'check_misplaced_pullquotes'])
+            tools.eq_(report.findings[2].message, 'error in check_thread: no thread')
+            tools.eq_(report.failed, ['check_thread'])
+            tools.eq_(log.getvalue(), '** error in check_thread: no thread\n')
+            tools.eq_(report.groomer, None)
+    finally:
+        x.check_threads = check_threads
+    tools.eq_(threads[0], threading.current_thread())
+    assert threads[1] is not threading.current_thread()
+
+
+def test_pipeline():
+    article = ('<article><front><journal-meta><journal-id journal-id-type="pmc">%s</journal-id>'
+               '</journal-meta><article-meta><article-categories><subj-group subj-group-type="heading">'
+               '<subject>%s</subject></subj-group></article-categories></article-meta></front></article>')
+    gated = [g for g in x.groomers if getattr(g, 'journals', None) or getattr(g, 'subjects', None)]
+    tools.eq_([g.__name__ for g in gated], ['check_correction_article', 'check_missing_blurb'])
+    for journal, subject, skipped in [('plosone', 'Research Article', ['check_correction_article',
+                                                                      'check_missing_blurb']),
+                                      ('plosmed', 'Clinical Trial', ['check_correction_article']),
+                                      ('plosone', 'Retraction', ['check_missing_blurb'])]:
+        root = etree.fromstring(article % (journal, subject))
+        report = x.Report()
+        x.run_groomers(root, gated, report, StringIO.StringIO())
+        tools.eq_(report.skipped, skipped)
+        # a skipped groomer would have done nothing
+        for groomer in gated:
+            if groomer.__name__ in skipped:
+                check(article % (journal, subject), '', groomer)
+    tools.eq_(x.pipeline(gated, 'plosone', 'Research Article'), x.pipeline(gated, 'plosgen', 'Essay'))
+    # without a journal or a single subject, everything runs
+    root = etree.fromstring(article.replace('pmc', 'nlm-ta') % ('PLoS ONE', 'Essay'))
+    report = x.Report()
+    x.run_groomers(root, gated, report, StringIO.StringIO())
+    tools.eq_(report.skipped, ['check_correction_article'])
+    tools.eq_(report.render(), '')
+    tools.eq_(report.render(dry_run=True),
+              'skipped, not for this journal or article type: check_correction_article\n')
+
+
+def test_query_cache():
+    root = etree.fromstring('<article><front><article-meta><volume>1</volume>'
+                            '</article-meta></front></article>')
+    seen = []
+
+    @x.reads('article-meta')
+    @x.read_only
+    def count_volumes(root, report):
+        seen.append(len(x.xpath(root, '//volume')))
+        return root
+
+    @x.reads('article-meta')
+    def add_volume(root, report):
+        x.xpath(root, '//article-meta')[0].append(etree.Element('volume'))
+        report.correction('added volume')
+        return root
+
+    x.xpath.counts.clear()
+    x.xpath.hits.clear()
+    x.run_groomers(root, [count_volumes, count_volumes, add_volume, count_volumes],
+                   x.Report(), StringIO.StringIO())
+    tools.eq_(seen, [1, 1, 2])
+    tools.eq_(x.xpath.counts['//volume'], 2)
+    tools.eq_(x.xpath.hits['//volume'], 1)
+    # outside a run nothing is cached
+    x.xpath(root, '//volume')
+    tools.eq_(x.xpath.counts['//volume'], 3)
+
+def test_article_index():
+    root = etree.fromstring(xmlgroomerbench.make_article())
+    index = x.article_index(root)
+    assert x.article_index(root) is index
+    tools.eq_(index.doi, '10.1371/journal.pone.0001234')
+    tools.eq_(index.doi_suffix, 'pone.0001234')
+    tools.eq_(index.kind(), ('plosone', 'Research Article'))
+    tools.eq_([node.text for node in index.epub('year')], ['2012'])
+    tools.eq_([node.text for node in index.heading_subjects], ['Research Article'])
+    tools.eq_([node.get('id') for node in index.tags['aff']], ['aff1', 'aff2', 'aff3', 'aff4', 'edit1'])
+
+    # groomers that change the tree drop the index
+    x.run_groomers(root, [x.fix_article_title], x.Report(), StringIO.StringIO())
+    assert x.article_index(root) is not index
+    index = x.article_index(root)
+    x.run_groomers(root, [x.check_nlm_ta], x.Report(), StringIO.StringIO())
+    assert x.article_index(root) is index
+    x.invalidate_index()
+
+def test_xpath_registry():
+    registry = x.XPathRegistry()
+    root = etree.fromstring('<article><ref><label>1</label></ref><ref><label>2</label></ref></article>')
+    tools.eq_([l.text for l in registry(root, '//ref/label')], ['1', '2'])
+    compiled = registry.compile('//ref/label')
+    tools.eq_([l.text for l in registry(root[1], 'label')], ['2'])
+    registry(root, '//ref/label')
+    tools.assert_true(registry.compile('//ref/label') is compiled)
+    tools.eq_(registry.counts, {'//ref/label': 2, 'label': 1})
+
+
 def test_get_singular_node():
     article = "<article><title-group><title>Bottlenose Dolphins</title><year>2013</year><year>2014></year></title-group></article>"
     root = etree.fromstring(article)
@@ -177,7 +383,46 @@ def test_fix_pubdate():
     	<article-id pub-id-type="doi">10.1371/journal.pone.0058162</article-id>
         <pub-date pub-type="epub"><day>13</day><month>3</month><year>2013</year></pub-date>
         </article-meta></article>'''
-    verify(before, after, x.fix_pubdate)
+    verify_with_pubdates(before, after, x.fix_pubdate,
+                         '10.1371/journal.pone.0058162\t2013-03-13\n')
+
+
+def test_pubdate_provider():
+    class CountingProvider(x.PubdateProvider):
+        fetched = []
+
+        def fetch(self, dois):
+            self.fetched.append(dois)
+            return dict((doi, '2013-03-13' if doi.endswith('1') else '') for doi in dois)
+    provider = CountingProvider()
+    tools.eq_(provider.lookup('doi.1'), '2013-03-13')
+    tools.eq_(provider.lookup_many(['doi.1', 'doi.2', 'doi.3', 'doi.2']),
+              {'doi.1': '2013-03-13', 'doi.2': '', 'doi.3': ''})
+    tools.eq_(provider.lookup('doi.2'), '')
+    tools.eq_(provider.fetched, [['doi.1'], ['doi.2', 'doi.3']])
+
+    class ExpiringProvider(x.PubdateProvider):
+        def fetch(self, dois):
+            self.memo = {}    # as the server expiring pubdates meanwhile
+            return dict.fromkeys(dois, '2013-03-13')
+    tools.eq_(ExpiringProvider().lookup('10.1371/journal.pone.0058162'), '2013-03-13')
+
+    tmp = tempfile.mkdtemp()
+    path = os.environ['PATH']
+    try:
+        with open(os.path.join(tmp, 'php'), 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 10\n')
+        os.chmod(os.path.join(tmp, 'php'), 0755)
+        os.environ['PATH'] = tmp + os.pathsep + path
+        provider = x.PhpPubdateProvider()
+        provider.timeout = 0.1
+        tools.assert_raises(RuntimeError, provider.lookup, '10.1371/journal.pone.0058162')
+        # the failure is remembered rather than waited for again
+        os.remove(os.path.join(tmp, 'php'))
+        tools.assert_raises(RuntimeError, provider.lookup, '10.1371/journal.pone.0058162')
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(tmp)
 
 
 def test_fix_pub_date_elements():
@@ -378,6 +623,14 @@ def test_fix_title():
     before = '''<article><title>Lipid <title>storage</title> in bulbils.  </title></article>'''
     after = '''<article><title>Lipid <title>storage</title> in bulbils.</title></article>'''
     verify(before, after, x.fix_title)
+    root = etree.fromstring('<sec><title>A <italic>b</italic> c<!-- d --> \n</title>\n<p>e </p>\n'
+                            '<fig><title><bold>F</bold> g\t</title>\n</fig></sec>')
+    report = x.Report()
+    x.fix_title(root, report)
+    tools.eq_(etree.tostring(root), '<sec><title>A <italic>b</italic> c<!-- d --></title><p>e </p>\n'
+                                    '<fig><title><bold>F</bold> g</title></fig></sec>')
+    tools.eq_(report.render(), 'correction: removed whitespace from end of title A \n'
+                               'correction: removed whitespace from end of title F g\t\n')
 
 
 def test_fix_headed_title():
@@ -419,6 +672,21 @@ def test_fix_formula():
         </article>'''
     verify(before, after, x.fix_formula)
 
+    # an inline-formula on the same line as the disp-formula it becomes
+    before = ('<article xmlns:xlink="http://www.w3.org/1999/xlink"><table><tr>\n'
+              '<td><inline-formula><mml:math xmlns:mml="http://www.w3.org/1998/Math/MathML"/>'
+              '</inline-formula><disp-formula id="e1"><graphic position="anchor" xlink:href="e1.tif"/>'
+              '</disp-formula></td>\n</tr></table></article>')
+    after = before.replace('<disp-formula id="e1"><graphic position="anchor"', '<inline-formula><inline-graphic') \
+                  .replace('</disp-formula>', '</inline-formula>')
+    verify(before, after, x.fix_formula)
+    root = etree.fromstring(before)
+    formula = root.find('table/tr/td/disp-formula')
+    formula.tag = 'inline-formula'
+    report = x.Report()
+    report.touch(formula)
+    assert not x.splice_article(root, report, before, StringIO.StringIO())
+
 
 def test_fix_formula_label():
     before = '''<article>
@@ -454,6 +722,32 @@ def test_fix_url():
     verify(before, after, x.fix_url)
 
 
+def test_normalize_link():
+    tools.eq_(x.normalize_link('10.1371/ journal.pbio.0020001', 'uri'),
+              ('http://dx.doi.org/10.1371/journal.pbio.0020001', 'http://10.1371/journal.pbio.0020001', 1))
+    tools.eq_(x.normalize_link('12345678', 'pmid'),
+              ('http://www.ncbi.nlm.nih.gov/pubmed/12345678', 'http://12345678', 1))
+    tools.eq_(x.normalize_link('http://example.org', 'uri'), ('http://example.org', None, 0))
+    # as fix_url did, a link that is no PMID must have a type
+    tools.assert_raises(KeyError, x.normalize_link, 'http://example.org', None)
+
+    square = x.LRUCache(lambda n: n * n, 4)
+    for n in [1, 2, 1, 3, 4, 1, 5]:
+        square(n)
+    tools.eq_((square.hits, square.misses), (2, 5))
+    # 1 stays while it is used, 2 and 3 were not used since their generation
+    tools.eq_(sorted(square.current.keys() + square.previous.keys()), [(1,), (4,), (5,)])
+
+    root = etree.fromstring('<article xmlns:xlink="http://www.w3.org/1999/xlink"><ext-link ext-link-type="uri" '
+                            'xlink:href="www.example.org/x"/><ext-link ext-link-type="uri" '
+                            'xlink:href="www.example.org/x"/></article>')
+    profile = x.Profile()
+    x.normalize_link.clear()
+    x.run_groomers(root, [x.fix_url], x.Report(), StringIO.StringIO(), profile=profile)
+    tools.eq_((profile.stats['fix_url']['memo_hits'], profile.stats['fix_url']['memo_misses']), (1, 1))
+    assert 'memo hits' in profile.render()
+
+
 def test_fix_page_range():
     before = '''<ref id="B1"><label>1</label>
         <mixed-citation publication-type="book"><source>Radiobiology for radiobiologists</source>. 
@@ -573,6 +867,58 @@ def test_check_article_type():
     message = 'error: Romantic Comedy is not a valid article type'
     check(before, message, x.check_article_type)
 
+
+def test_article_journal():
+    article = '<article><front><journal-meta>%s</journal-meta></front></article>'
+    pmc = '<journal-id journal-id-type="pmc">%s</journal-id>'
+    title = '<journal-title-group><journal-title>%s</journal-title></journal-title-group>'
+    index = x.ArticleIndex(etree.fromstring(article % (pmc % 'plosbiol')))
+    tools.eq_((index.journal.title, index.journal.founded, index.journal.blurb), ('PLoS Biology', 2003, True))
+    index = x.ArticleIndex(etree.fromstring(article % (pmc % 'plosxyz' + title % 'PLoS ONE')))
+    tools.eq_((index.journal.pmc, index.journal.collection_month), ('plosone', False))
+    tools.eq_(index.kind(), ('plosone', None))
+    index = x.ArticleIndex(etree.fromstring(article % (pmc % 'plosxyz')))
+    tools.eq_(index.journal, None)
+    tools.eq_(index.kind(), ('plosxyz', None))
+    assert 'PLoS Curr' in x.vocabulary.nlm_tas
+    tools.eq_(x.vocabulary.blurb_journals, frozenset(['plosbiol', 'plosmed']))
+
+
+def test_vocabulary():
+    article = '''<article><front><journal-meta><journal-id journal-id-type="pmc">%s</journal-id></journal-meta>
+        <article-meta><article-categories><subj-group subj-group-type="heading">
+        <subject>Romantic Comedy</subject></subj-group></article-categories></article-meta></front></article>'''
+    tmp = tempfile.mkdtemp()
+    vocabulary = x.vocabulary
+    try:
+        with open(x.VOCABULARY_PATH) as f:
+            data = json.load(f)
+        for journal in data['journals']:
+            if journal.get('pmc') == 'plosmed':
+                journal['article_types'] = ['Romantic Comedy']
+        path = os.path.join(tmp, 'vocabulary.json')
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        x.reload_vocabulary(path)
+        check(article % 'plosmed', '', x.check_article_type)
+        check(article % 'plosone', 'error: Romantic Comedy is not a valid article type', x.check_article_type)
+
+        # an edited file is picked up, a broken one ignored
+        data['article_type_fixes']['Research Artikel'] = 'Research Article'
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        os.utime(path, (0, 0))
+        x.refresh_vocabulary()
+        tools.eq_(x.vocabulary.article_type_fixes['Research Artikel'], 'Research Article')
+        with open(path, 'w') as f:
+            f.write('{')
+        os.utime(path, (1, 1))
+        x.refresh_vocabulary()
+        assert 'Research Artikel' in x.vocabulary.article_type_fixes
+    finally:
+        x.vocabulary = vocabulary
+        shutil.rmtree(tmp)
+
 def test_check_correction_article():
     before = '''<article>
         <article-categories>
@@ -774,6 +1120,8 @@ def test_check_missing_blurbs():
 </article>'''
     message = "warning: article xml is missing 'blurb'\n"
     check(before, message, x.check_missing_blurb)
+    check(before.replace('plosmed', 'plosbiol'), message, x.check_missing_blurb)
+    check(before.replace('plosmed', 'plosone'), '', x.check_missing_blurb)
 
 
 def test_check_SI_attributes():
@@ -917,6 +1265,21 @@ def test_check_collab_markup():
     check(before, message, x.check_collab_markup)
 
 
+def test_looks_like_collab():
+    # the regex check_collab_markup used before looks_like_collab
+    pattern = ("\S*\s\S*\s\S*\s\S*|\sthe\s|\sfor\s|\sof\s|\son\s|\sin\s|\swith\s|\sgroup\s|\scenter|"
+               "\sorganization|\sorganizing|\scollaboration|\scollaborative\s|\scommittee|\scouncil|"
+               "\sconsortium|\sassociation|\spartnership|\sproject|\steam|\ssociety\s")
+    names = ['James', ' of ', 'de la Cruz y Ortega', 'van der Berg', 'Smith Theory', 'The Group', 'Brain Group ',
+             'A\tOf\tB', ' of', 'Anne  Marie', 'X Teamwork', 'The Center', 'Ocenter', 'X collaborator',
+             'X collaborative', 'X collaborative ', u'X Tİam', u'X Kouncil', u'A\xa0of\xa0B',
+             'X\x0bsociety\x0c', '', ' ']
+    for name in names:
+        tools.eq_(x.looks_like_collab(name), bool(re.search(pattern, name, re.IGNORECASE)), repr(name))
+    tools.eq_(x.words('For the\tTEAM  '), ['for', 'the', 'team', '', ''])
+    tools.assert_raises(TypeError, x.looks_like_collab, None)
+
+
 def test_check_collab_children():
     before = '''
 <article xmlns:xlink="http://www.w3.org/1999/xlink">
@@ -1158,3 +1521,333 @@ def test_alert_merops_validator_error():
     message = ''
 
     check_char_stream(before, message, x.alert_merops_validator_error)
+
+
+def test_scan_char_stream():
+    before = u'<p>a\ue001b [!bad\ue002 value!] c\ue003</p>' + u' '*30
+    report = x.Report()
+    result = x.scan_char_stream(before, report, x.char_stream_groomers)
+    tools.eq_(result, u'<p>ab [!bad value!] c</p>' + u' '*30)
+    expected = x.Report()
+    x.alert_merops_validator_error(x.remove_pua_set(before, expected), expected)
+    tools.eq_(report.render(), expected.render())
+    tools.eq_([f.groomer for f in report.findings],
+              ['remove_pua_set']*3 + ['alert_merops_validator_error'])
+    # deletions can make a merops match, or take one over the length limit
+    for before in [u'[\ue000!bad!]', u'[!' + u'a'*99 + u'\ue000\ue001!]',
+                   u'[!' + u'a'*99 + u'!\ue000]']:
+        report = x.Report()
+        result = x.scan_char_stream(before, report, x.char_stream_groomers)
+        expected = x.Report()
+        tools.eq_(result, x.alert_merops_validator_error(x.remove_pua_set(before, expected), expected))
+        tools.eq_(report.render(), expected.render())
+        assert 'alert_merops_validator_error' in [f.groomer for f in report.findings]
+
+
+def test_needs_char_scan():
+    rules = x.char_stream_groomers
+    assert not x.needs_char_scan(u'<p>estrogen \u03b2 [!</p>'.encode('utf-8'), rules)
+    assert x.needs_char_scan(u'<p>estrogen \ue000</p>'.encode('utf-8'), rules)
+    assert x.needs_char_scan(u'<p>estrogen \uf8ff</p>'.encode('utf-8'), rules)
+    assert not x.needs_char_scan(u'<p>estrogen \uf900</p>'.encode('utf-8'), rules)
+    assert x.needs_char_scan(u'<p>[!\u03b2\u03b2!]</p>'.encode('utf-8'), rules)
+    tools.assert_raises(UnicodeDecodeError, x.check_utf8, '<p>\xe2\x80</p>', 4)
+
+def test_batch_articles():
+    tmp = tempfile.mkdtemp()
+    try:
+        for name in ['a.xml', 'b.xml', 'notes.txt']:
+            open(os.path.join(tmp, name), 'w').close()
+        manifest = os.path.join(tmp, 'manifest')
+        with open(manifest, 'w') as f:
+            f.write('# before\tafter\n/in/c.xml\t/out/c.xml\n/in/d.xml\n\n')
+        articles = x.batch_articles([tmp], '/out', manifest)
+        tools.eq_(articles, [(os.path.join(tmp, 'a.xml'), '/out/a.xml'),
+                             (os.path.join(tmp, 'b.xml'), '/out/b.xml'),
+                             ('/in/c.xml', '/out/c.xml'),
+                             ('/in/d.xml', None)])
+        articles = x.batch_articles([os.path.join(tmp, 'b*')])
+        tools.eq_(articles, [(os.path.join(tmp, 'b.xml'), None)])
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_parse_front():
+    article = ('<!DOCTYPE article SYSTEM "a.dtd"><article article-type="x"><front><!-- </front> -->'
+               '<article-meta/></front><body>%s</body></article>' % ('<p>x</p>' * 100000))
+    root, read = x.parse_front(article)
+    tools.eq_(etree.tostring(root), '<article article-type="x"><front><!-- </front> -->'
+                                    '<article-meta/></front></article>')
+    tools.eq_(root.getroottree().docinfo.doctype, '<!DOCTYPE article SYSTEM "a.dtd">')
+    assert read < len(article) / 2
+    root, read = x.parse_front('<article><body/></article>')
+    tools.eq_(etree.tostring(root), '<article><body/></article>')
+    # where reading stopped can split a character
+    split = 0
+    for padding in range(6):
+        article = ('<article><front/><body>%s<p>%s</p></body></article>'
+                   % (' ' * padding, u'caf\xe9 '.encode('utf-8') * 20000))
+        root, read = x.parse_front(article)
+        x.check_utf8(article[:read], final=False)
+        try:
+            article[:read].decode('utf-8')
+        except UnicodeDecodeError:
+            split += 1
+    assert split
+    tools.assert_raises(UnicodeDecodeError, x.check_utf8, 'caf\xff', final=False)
+    assert all(getattr(fn, 'front_matter', False) for fn in x.validators)
+
+
+def test_splice_article():
+    before = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<article xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+              '<front><article-meta><volume>1</volume><issue\n'
+              '  id="i">2</issue><fpage>1</fpage>\n'
+              '<elocation-id>e1</elocation-id><!-- <elocation-id/> --></article-meta></front>\n'
+              '<body><p>&#x3B2; <ext-link xlink:href="www.a.org">a</ext-link></p></body>\n'
+              '</article>\n')
+    root = etree.fromstring(before)
+    report = x.Report()
+    volume, issue, fpage, eloc = root.find('front/article-meta')[:4]
+    volume.text = '2'
+    issue.text = '3'
+    link = root.find('body/p/ext-link')
+    link.set('{http://www.w3.org/1999/xlink}href', 'http://www.a.org')
+    report.touch(volume, issue, link)
+    f = StringIO.StringIO()
+    assert x.splice_article(root, report, before, f)
+    tools.eq_(f.getvalue(), before.replace('>1</volume>', '>2</volume>')
+                                  .replace('<issue\n  id="i">2', '<issue id="i">3')
+                                  .replace('"www.a.org"', '"http://www.a.org"'))
+
+    # that line also has an <elocation-id> in a comment
+    report.touch(eloc)
+    f = StringIO.StringIO()
+    assert not x.splice_article(root, report, before, f)
+    tools.eq_(f.getvalue(), '')
+
+    report.touch(fpage.getparent())
+    fpage.getparent().remove(fpage)
+    assert x.splice_article(root, report, before, f)
+    tools.eq_(etree.tostring(etree.fromstring(f.getvalue()), method='c14n'),
+              etree.tostring(root, method='c14n'))
+    assert '&#x3B2;' in f.getvalue()
+
+    report = x.Report()
+    report.touch(root)
+    assert not x.splice_article(root, report, before, f)
+    report = x.Report()
+    report.untracked = True
+    assert not x.splice_article(root, report, before, f)
+    for groomer in x.groomers:
+        assert getattr(groomer, 'read_only', False) or getattr(groomer, 'tracks_changes', False), groomer
+
+
+def test_write_article():
+    for before in ['<!DOCTYPE article PUBLIC "-//NLM//DTD Journal Publishing DTD v3.0 20080202//EN" '
+                   '"journalpublishing3.dtd">\n<article><title>\xc3\xa9</title></article>',
+                   '<?pi x?><!DOCTYPE a [<!ENTITY e "x">]><a>&e;</a><!-- after -->',
+                   '<a>x</a>']:
+        tree = etree.fromstring(before).getroottree()
+        goal = StringIO.StringIO()
+        tree.write(goal, xml_declaration=True, encoding='UTF-8')
+        result = StringIO.StringIO()
+        x.write_article(tree.getroot(), result)
+        tools.eq_(result.getvalue(), goal.getvalue())
+
+
+def test_groom_stdin():
+    tmp = tempfile.mkdtemp()
+    provider = x.pubdate_provider
+    stdin, stdout = x.sys.stdin, x.sys.stdout
+    try:
+        x.pubdate_provider = xmlgroomerbench.BenchPubdateProvider()
+        data = xmlgroomerbench.make_article(pua=0)
+        root, report = x.groom_article(data, False, StringIO.StringIO())
+        goal = etree.tostring(root, method='c14n')
+        before = os.path.join(tmp, 'before.xml')
+        with open(before, 'wb') as f:
+            f.write(data)
+        read, write = os.pipe()
+        os.write(write, data)    # small enough for the pipe's buffer
+        os.close(write)
+        # redirected from a file, so mapped, and piped
+        for source in [open(before, 'rb'), os.fdopen(read, 'rb')]:
+            after = os.path.join(tmp, 'after.xml')
+            x.sys.stdin = source
+            x.sys.stdout = open(after, 'wb')
+            try:
+                output = x.groom_file('-', '-', False, StringIO.StringIO())
+            finally:
+                x.sys.stdout.close()
+                x.sys.stdin = stdin
+                x.sys.stdout = stdout
+                source.close()
+            tools.eq_(etree.tostring(etree.parse(after), method='c14n'), goal)
+            tools.eq_(output, report.render())
+    finally:
+        x.sys.stdin, x.sys.stdout = stdin, stdout
+        x.pubdate_provider = provider
+        shutil.rmtree(tmp)
+
+
+def test_result_cache():
+    tmp = tempfile.mkdtemp()
+    provider = x.pubdate_provider
+    try:
+        x.pubdate_provider = xmlgroomerbench.BenchPubdateProvider()
+        before = os.path.join(tmp, 'before.xml')
+        with open(before, 'w') as f:
+            f.write(xmlgroomerbench.make_article())
+        cache = x.ResultCache(os.path.join(tmp, 'cache'))
+        data = open(before).read()
+
+        outputs = []
+        for i in range(2):
+            log = StringIO.StringIO()
+            after = os.path.join(tmp, 'after%d.xml' % i)
+            outputs.append(x.groom_file(before, after, False, log, cache=cache))
+            tools.eq_('cached result' in log.getvalue(), i == 1)
+        tools.eq_(outputs[0], outputs[1])
+        tools.eq_(open(os.path.join(tmp, 'after0.xml')).read(), open(os.path.join(tmp, 'after1.xml')).read())
+        assert cache.fresh(cache.key(data, 'groom'), 'groom')
+        assert not cache.fresh(cache.key(data, 'dry-run'), 'dry-run')
+
+        # a changed EM pubdate misses the cache
+        x.pubdate_provider.memo = dict.fromkeys(x.pubdate_provider.memo, '2012-06-01')
+        log = StringIO.StringIO()
+        x.groom_file(before, os.path.join(tmp, 'after2.xml'), False, log, cache=cache)
+        assert 'cached result' not in log.getvalue()
+
+        # results with failing groomers are not cached
+        x.pubdate_provider = x.FilePubdateProvider(os.devnull)
+        x.groom_file(before, None, False, StringIO.StringIO(), cache=cache)
+        assert not cache.fresh(cache.key(data, 'dry-run'), 'dry-run')
+
+        cache.max_bytes = 0
+        x.groom_file(before, None, True, StringIO.StringIO(), cache=cache)
+        tools.eq_(os.listdir(cache.directory), [])
+    finally:
+        x.pubdate_provider = provider
+        shutil.rmtree(tmp)
+
+def test_incremental_groom():
+    tmp = tempfile.mkdtemp()
+    provider = x.pubdate_provider
+    try:
+        x.pubdate_provider = xmlgroomerbench.BenchPubdateProvider()
+        root, report = x.groom_article(xmlgroomerbench.make_article(), False, StringIO.StringIO())
+        groomed = etree.tostring(root)
+        revised = groomed.replace('Cells were treated', 'Cells were first treated', 1)
+        history = x.GroomHistory(tmp)
+
+        x.groom_article(groomed, False, StringIO.StringIO(), history=history)
+        log = StringIO.StringIO()
+        root, report = x.groom_article(revised, False, log, history=history)
+        full_root, full_report = x.groom_article(revised, False, StringIO.StringIO())
+        tools.eq_(report.render(), full_report.render())
+        tools.eq_(etree.tostring(root), etree.tostring(full_root))
+        assert 'reused the findings of 0 groomers' not in log.getvalue()
+
+        # a changed region reruns the groomers reading it
+        article_history = history.load(x.get_doi(root), False)
+        root = etree.fromstring(revised.replace('Author1<', 'Group for Author1<'))
+        report = x.Report()
+        x.run_groomers(root, x.groomers, report, StringIO.StringIO(), history=article_history)
+        assert 'collaborative author' in report.render()
+        assert article_history.reused > 0
+    finally:
+        x.pubdate_provider = provider
+        shutil.rmtree(tmp)
+
+def test_incremental_regions():
+    # revisions outside what the groomers used to declare they read
+    contribs = ('<article><sub-article><front-stub><contrib-group>'
+                '<contrib contrib-type="author">%s</contrib></contrib-group></front-stub></sub-article></article>')
+    revisions = [
+        (x.fix_headed_title, '<article><body><sec><title>Methods:</title></sec></body></article>',
+         '<article><body><sec sec-type="headed"><title>Methods:</title></sec></body></article>'),
+        (x.fix_comment, '<article><body><sec><ref-list><ref><label>1</label><mixed-citation>'
+                        '<comment>c</comment> x</mixed-citation></ref></ref-list></sec></body></article>',
+         '<article><body><sec><ref-list><ref><label>1</label><mixed-citation>'
+         '<comment>c</comment>. x</mixed-citation></ref></ref-list></sec></body></article>'),
+        (x.check_au_names_for_beta, contribs % '<name><surname>Weiss</surname><given-names>A</given-names></name>',
+         contribs % u'<name><surname>Wei\u03b2</surname><given-names>A</given-names></name>'.encode('utf-8')),
+        (x.check_collab_children, contribs % '<collab>Group</collab>',
+         contribs % '<collab>Group<contrib-group><contrib/></contrib-group></collab>'),
+    ]
+    tmp = tempfile.mkdtemp()
+    try:
+        for groomer, before, revised in revisions:
+            path = os.path.join(tmp, groomer.__name__)
+            history = x.ArticleHistory(path, 'test')
+            x.run_groomers(etree.fromstring(before), [groomer], x.Report(), StringIO.StringIO(),
+                           history=history)
+            history.save()
+            report = x.Report()
+            root = x.run_groomers(etree.fromstring(revised), [groomer], report, StringIO.StringIO(),
+                                  history=x.ArticleHistory(path, 'test'))
+            full_report = x.Report()
+            full_root = x.run_groomers(etree.fromstring(revised), [groomer], full_report, StringIO.StringIO())
+            assert full_report.findings, groomer.__name__
+            tools.eq_(report.render(), full_report.render())
+            tools.eq_(etree.tostring(root), etree.tostring(full_root))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_groom_server():
+    server = xmlgroomerserver.make_server(('127.0.0.1', 0), workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('GET', '/health')
+        tools.eq_(json.loads(conn.getresponse().read())['status'], 'ok')
+
+        article = """<article><front><article-meta>
+            <article-id pub-id-type="doi">10.1371/journal.pone.0058162</article-id>
+            <pub-date pub-type="epub"><day>4</day><month>1</month><year>2012</year></pub-date>
+            </article-meta></front></article>"""
+        provider = x.pubdate_provider
+        x.pubdate_provider = x.PubdateProvider()
+        x.pubdate_provider.memo['10.1371/journal.pone.0058162'] = '2013-03-13'
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+            conn.request('POST', '/groom?mode=error-check', article)
+            result = json.loads(conn.getresponse().read())
+        finally:
+            x.pubdate_provider = provider
+        tools.eq_(result, {'xml': None,
+                           'report': 'error: pubdate defined in xml (2012-01-04) does not '
+                                     'match EM pubdate (2013-03-13)\n'})
+
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('POST', '/groom?mode=bogus', article)
+        tools.eq_(conn.getresponse().status, 400)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bench_article():
+    provider = x.pubdate_provider
+    try:
+        x.pubdate_provider = xmlgroomerbench.BenchPubdateProvider()
+        data = xmlgroomerbench.make_article(**xmlgroomerbench.scaled(2))
+        for error_check in [False, True]:
+            log = StringIO.StringIO()
+            root, report = x.groom_article(data, error_check, log)
+            assert '** error' not in log.getvalue(), log.getvalue()
+            tools.eq_(len(root.findall('front/article-meta/contrib-group/contrib')), 16)
+            # error checks stop parsing at </front>
+            tools.eq_(len(root.findall('back/ref-list/ref')), 0 if error_check else 80)
+
+        pubdates = x.pubdate_provider
+        bench = xmlgroomerbench.run_benchmark([1, 2], repeat=1, out=StringIO.StringIO())
+        assert x.pubdate_provider is pubdates
+        names = set(result['name'] for result in bench['results'])
+        assert set(g.__name__ for g in x.groomers + x.validators) <= names
+    finally:
+        x.pubdate_provider = provider